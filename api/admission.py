@@ -0,0 +1,292 @@
+"""
+Controle de admissão e backpressure da API.
+
+- Uploads (POST /pet): limite de requisições simultâneas e de bytes em trânsito, verificado antes
+  do multipart ser lido (ADMISSION_MAX_UPLOADS, ADMISSION_MAX_UPLOAD_BYTES).
+- Taxa por cliente/IP (token bucket): RATE_LIMIT_PET_PER_MIN e RATE_LIMIT_TELEMETRY_PER_MIN.
+- Fila de processamento limitada com PROCESS_WORKERS threads. A capacidade se adapta à vazão
+  observada (tempo médio por pedido, dominado pelo Gemini): cabe na fila o que os workers
+  conseguem processar em PROCESS_QUEUE_TARGET_WAIT_S, até PROCESS_QUEUE_MAX. Pedidos que não
+  couberam (o webhook responde 200 mesmo assim) ficam pagos e pendentes no store e são
+  reenfileirados por uma varredura a cada PROCESS_SWEEP_SECONDS (0 desativa).
+
+Rejeições levantam Rejeitado; em /pet e /telemetry/event a API responde 429 (ou 413) com Retry-After.
+"""
+import math
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from contextlib import contextmanager
+
+import metrics
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+class Rejeitado(Exception):
+    """Requisição recusada por limite; retry_after em segundos vai no header Retry-After."""
+
+    def __init__(self, motivo: str, retry_after: int, status: int = 429):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.retry_after = max(1, int(retry_after))
+        self.status = status
+
+
+class LimiteTaxa:
+    """Token bucket por cliente; guarda no máximo max_clientes buckets (LRU)."""
+
+    def __init__(self, por_minuto: float, rajada: int | None = None, max_clientes: int = 10_000):
+        self.taxa = por_minuto / 60.0
+        self.rajada = float(rajada if rajada is not None else max(1, int(por_minuto)))
+        self.max_clientes = max_clientes
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consumir(self, cliente: str) -> float:
+        """Consome um token. Retorna 0 se permitido, senão os segundos até o próximo token."""
+        if self.taxa <= 0:
+            return 0.0
+        agora = time.monotonic()
+        with self._lock:
+            tokens, ultimo = self._buckets.pop(cliente, (self.rajada, agora))
+            tokens = min(self.rajada, tokens + (agora - ultimo) * self.taxa)
+            espera = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                espera = (1 - tokens) / self.taxa
+            self._buckets[cliente] = (tokens, agora)
+            if len(self._buckets) > self.max_clientes:
+                self._buckets.popitem(last=False)
+        return espera
+
+
+class LimiteUploads:
+    """Limita uploads simultâneos e a soma de bytes declarados (Content-Length) em trânsito."""
+
+    def __init__(self, max_uploads: int, max_bytes: int):
+        self.max_uploads = max_uploads
+        self.max_bytes = max_bytes
+        self._ativos = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def admitir(self, n_bytes: int):
+        with self._lock:
+            # Um upload sozinho sempre passa (o tamanho por requisição é validado à parte).
+            if self._ativos >= self.max_uploads or (
+                self._ativos and self._bytes + n_bytes > self.max_bytes
+            ):
+                metrics.ADMISSION_REJECTED.inc(motivo="uploads")
+                raise Rejeitado("Muitos envios em andamento. Tente novamente em instantes.", 5)
+            self._ativos += 1
+            self._bytes += n_bytes
+            metrics.UPLOADS_IN_FLIGHT.set(self._ativos)
+            metrics.UPLOAD_BYTES_IN_FLIGHT.set(self._bytes)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._ativos -= 1
+                self._bytes -= n_bytes
+                metrics.UPLOADS_IN_FLIGHT.set(self._ativos)
+                metrics.UPLOAD_BYTES_IN_FLIGHT.set(self._bytes)
+
+
+class FilaProcessamento:
+    """
+    Fila limitada de pedidos pagos, consumida por `workers` threads que chamam processar(pedido, trace).
+    processar deve retornar True em sucesso; só sucessos alimentam a média de tempo por pedido.
+    """
+
+    EWMA_ALPHA = 0.2
+
+    def __init__(
+        self,
+        processar: Callable[[dict, bool], bool],
+        workers: int | None = None,
+        capacidade_max: int | None = None,
+        espera_alvo_s: float | None = None,
+        pendentes: Callable[[], list[dict]] | None = None,
+        varredura_s: float | None = None,
+    ):
+        self.processar = processar
+        self.pendentes = pendentes
+        self.varredura_s = _env_float("PROCESS_SWEEP_SECONDS", 300.0) if varredura_s is None else varredura_s
+        self.workers = max(1, workers or _env_int("PROCESS_WORKERS", 2))
+        self.capacidade_max = max(1, capacidade_max or _env_int("PROCESS_QUEUE_MAX", 100))
+        self.espera_alvo_s = espera_alvo_s or _env_float("PROCESS_QUEUE_TARGET_WAIT_S", 1800.0)
+        self._fila: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._aguardando = 0
+        self._em_andamento: set[str] = set()  # enfileirados ou processando (evita duplicar por reenvio do webhook)
+        self._segundos_por_pedido: float | None = None
+        self._threads: list[threading.Thread] = []
+        self._parar = threading.Event()
+        self._varredor: threading.Thread | None = None
+
+    def capacidade(self) -> int:
+        """Máximo de pedidos aguardando: o que os workers processam em espera_alvo_s na vazão observada."""
+        if self._segundos_por_pedido is None:
+            return self.capacidade_max
+        vazao = self.workers / self._segundos_por_pedido
+        return max(self.workers, min(self.capacidade_max, int(vazao * self.espera_alvo_s)))
+
+    def retry_after(self) -> int:
+        por_pedido = self._segundos_por_pedido or 60.0
+        return min(3600, max(5, math.ceil(self._aguardando * por_pedido / self.workers)))
+
+    def enfileirar(self, pedido: dict, trace: bool = False) -> bool:
+        """Enfileira o pedido. Retorna False se já estava na fila/processando; levanta Rejeitado se cheia."""
+        order_id = pedido["order_id"]
+        with self._lock:
+            if order_id in self._em_andamento:
+                return False
+            capacidade = self.capacidade()
+            metrics.QUEUE_CAPACITY.set(capacidade)
+            if self._aguardando >= capacidade:
+                metrics.ADMISSION_REJECTED.inc(motivo="fila")
+                raise Rejeitado("Fila de processamento cheia.", self.retry_after())
+            self._aguardando += 1
+            self._em_andamento.add(order_id)
+            metrics.QUEUE_DEPTH.set(self._aguardando)
+        self._fila.put((pedido, trace))
+        return True
+
+    def _worker(self) -> None:
+        while True:
+            item = self._fila.get()
+            if item is None:
+                return
+            pedido, trace = item
+            with self._lock:
+                self._aguardando -= 1
+                metrics.QUEUE_DEPTH.set(self._aguardando)
+            inicio = time.monotonic()
+            ok = False
+            try:
+                ok = self.processar(pedido, trace)
+            finally:
+                duracao = time.monotonic() - inicio
+                with self._lock:
+                    self._em_andamento.discard(pedido["order_id"])
+                    if ok:
+                        anterior = self._segundos_por_pedido
+                        self._segundos_por_pedido = (
+                            duracao if anterior is None
+                            else anterior + self.EWMA_ALPHA * (duracao - anterior)
+                        )
+                    metrics.QUEUE_CAPACITY.set(self.capacidade())
+
+    def varrer(self) -> int:
+        """Enfileira pedidos pendentes (pendentes()) até a fila encher. Retorna quantos entraram."""
+        if self.pendentes is None:
+            return 0
+        novos = 0
+        for pedido in self.pendentes():
+            try:
+                novos += self.enfileirar(pedido)
+            except Rejeitado:
+                break
+        return novos
+
+    def _varrer_periodicamente(self) -> None:
+        while not self._parar.wait(self.varredura_s):
+            try:
+                self.varrer()
+            except Exception as e:
+                print(f"Varredura da fila de processamento falhou: {e}", flush=True)
+
+    def start(self) -> None:
+        metrics.QUEUE_CAPACITY.set(self.capacidade())
+        self._parar.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"processar-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        if self.pendentes is not None and self.varredura_s > 0:
+            self._varredor = threading.Thread(target=self._varrer_periodicamente, name="varrer-pendentes", daemon=True)
+            self._varredor.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Sinaliza os workers para sair após o pedido atual. Pedidos não iniciados continuam
+        pagos e pendentes no store e são retomados por process.py ou pela próxima varredura."""
+        self._parar.set()
+        if self._varredor is not None:
+            self._varredor.join(timeout)
+            self._varredor = None
+        for _ in self._threads:
+            self._fila.put(None)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads.clear()
+
+
+_uploads = LimiteUploads(
+    max_uploads=_env_int("ADMISSION_MAX_UPLOADS", 8),
+    max_bytes=_env_int("ADMISSION_MAX_UPLOAD_BYTES", 150 * 1024 * 1024),
+)
+_taxas = {
+    ("POST", "/pet"): LimiteTaxa(_env_float("RATE_LIMIT_PET_PER_MIN", 6)),
+    ("POST", "/telemetry/event"): LimiteTaxa(_env_float("RATE_LIMIT_TELEMETRY_PER_MIN", 120)),
+}
+
+
+def _saltos_confiaveis() -> int:
+    """TRUSTED_PROXY_HOPS; TRUST_PROXY_HEADERS=true (legado) equivale a 1."""
+    legado = os.getenv("TRUST_PROXY_HEADERS", "false").strip().lower() in ("true", "1")
+    return max(0, _env_int("TRUSTED_PROXY_HOPS", 1 if legado else 0))
+
+
+def client_ip(headers, peer: str | None) -> str:
+    """
+    IP do cliente. Com TRUSTED_PROXY_HOPS=N (N proxies confiáveis na frente da API), usa a N-ésima
+    entrada do X-Forwarded-For contando da direita: as da esquerda vêm do cliente e podem ser forjadas.
+    Com 0 (default), usa o IP da conexão.
+    """
+    saltos = _saltos_confiaveis()
+    if saltos:
+        entradas = [e.strip() for e in (headers.get("x-forwarded-for") or "").split(",") if e.strip()]
+        if entradas:
+            return entradas[-min(saltos, len(entradas))]
+    return peer or "desconhecido"
+
+
+@contextmanager
+def admitir_requisicao(method: str, path: str, cliente: str, content_length: str | None, max_body: int):
+    """Aplica limite de taxa e, em POST /pet, o limite de uploads. Levanta Rejeitado se recusar."""
+    limite = _taxas.get((method, path))
+    if limite is not None:
+        espera = limite.consumir(cliente)
+        if espera > 0:
+            metrics.ADMISSION_REJECTED.inc(motivo="taxa")
+            raise Rejeitado("Muitas requisições. Tente novamente em instantes.", math.ceil(espera))
+    if (method, path) != ("POST", "/pet"):
+        yield
+        return
+    try:
+        n_bytes = int(content_length) if content_length else max_body
+    except ValueError:
+        n_bytes = max_body
+    if n_bytes > max_body:
+        metrics.ADMISSION_REJECTED.inc(motivo="tamanho")
+        raise Rejeitado("Envio maior que o permitido.", 60, status=413)
+    with _uploads.admitir(n_bytes):
+        yield
@@ -0,0 +1,147 @@
+"""
+Arquivamento (camada fria) de pedidos processados.
+Pedidos com status processado há mais de ARCHIVE_AFTER_DAYS dias (default 30) saem do orders.json
+para data/archive/orders-YYYY-MM.json (por mês de criação), com índice em data/archive/index.json.
+A pasta uploads/{order_id} vira um único zip em data/archive/uploads/YYYY-MM/{order_id}.zip.
+
+store.get_order consulta a camada fria automaticamente. Arquivos de pedidos arquivados (ex.: livro.pdf)
+são extraídos sob demanda, um por vez, para data/archive/cache/{order_id}/ (pode ser apagado a qualquer hora).
+
+Pode rodar com a API no ar: as operações do store seguram um flock em data/orders.lock, então
+pedidos criados ou pagos durante o arquivamento não se perdem.
+
+Rode com: uv run archive.py [--dias 30] [--limite N] [--dry-run] [--limpar-cache]
+"""
+import argparse
+import os
+import shutil
+import sys
+import uuid
+import zipfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+import store
+
+load_dotenv()
+
+# Formatos já comprimidos: deflate só gastaria CPU.
+_SEM_COMPRESSAO = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def _cache_dir() -> Path:
+    return store.ARCHIVE_DIR / "cache"
+
+
+def _data_conclusao(pedido: dict) -> str:
+    return pedido.get("updated_at") or pedido.get("created_at") or ""
+
+
+def elegiveis(dias: int, agora: datetime | None = None) -> list[dict]:
+    """Pedidos processados cuja última atualização é anterior a `dias` dias atrás (mais antigos primeiro)."""
+    limite = ((agora or datetime.utcnow()) - timedelta(days=dias)).isoformat() + "Z"
+    pedidos = [p for p in store.list_processed() if _data_conclusao(p) < limite]
+    pedidos.sort(key=_data_conclusao)
+    return pedidos
+
+
+def _empacotar(order_id: str, mes: str) -> str | None:
+    """Compacta uploads/{order_id} num zip (via .tmp + rename). Retorna o caminho relativo ou None se não há pasta."""
+    pasta = store.UPLOADS_DIR / order_id
+    if not pasta.is_dir():
+        return None
+    rel = f"uploads/{mes}/{order_id}.zip"
+    destino = store.ARCHIVE_DIR / rel
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    tmp = destino.with_name(destino.name + ".tmp")
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        for path in sorted(pasta.iterdir()):
+            if not path.is_file() or path.suffix == ".tmp":
+                continue
+            tipo = zipfile.ZIP_STORED if path.suffix.lower() in _SEM_COMPRESSAO else zipfile.ZIP_DEFLATED
+            zf.write(path, arcname=path.name, compress_type=tipo)
+    os.replace(tmp, destino)
+    return rel
+
+
+def arquivar(dias: int, limite: int | None = None, dry_run: bool = False) -> list[str]:
+    """Move pedidos elegíveis para a camada fria e apaga suas pastas de upload. Retorna os order_ids arquivados."""
+    candidatos = elegiveis(dias)
+    if limite:
+        candidatos = candidatos[:limite]
+    if dry_run:
+        for pedido in candidatos:
+            print(f"{pedido['order_id']}  concluído em {_data_conclusao(pedido)}")
+        return [p["order_id"] for p in candidatos]
+
+    agora = datetime.utcnow().isoformat() + "Z"
+    entradas: dict[str, dict] = {}
+    for pedido in candidatos:
+        order_id = pedido["order_id"]
+        mes = (pedido.get("created_at") or agora)[:7]
+        entradas[order_id] = {
+            "orders_file": f"orders-{mes}.json",
+            "zip": _empacotar(order_id, mes),
+            "archived_at": agora,
+        }
+    movidos = store.archive_orders(entradas) if entradas else []
+    for order_id in movidos:
+        shutil.rmtree(store.UPLOADS_DIR / order_id, ignore_errors=True)
+    # Zips de pedidos que mudaram de status no meio do caminho não são referenciados: descarta.
+    for order_id in set(entradas) - set(movidos):
+        if entradas[order_id]["zip"]:
+            (store.ARCHIVE_DIR / entradas[order_id]["zip"]).unlink(missing_ok=True)
+    return movidos
+
+
+def arquivo_do_pedido(order_id: str, nome: str) -> Path | None:
+    """
+    Caminho de um arquivo do pedido (ex.: livro.pdf). Se o pedido está arquivado, extrai só esse
+    membro do zip para o cache na primeira chamada. Retorna None se não existir.
+    order_id e nome viram caminhos: quem recebe order_id de fora confere antes que o pedido existe
+    (ex.: GET /order/{order_id}/livro); aqui só nomes simples passam.
+    """
+    if Path(nome).name != nome or Path(order_id).name != order_id or order_id in ("", ".", ".."):
+        return None
+    local = store.UPLOADS_DIR / order_id / nome
+    if local.is_file():
+        return local
+    entrada = store.get_archive_entry(order_id)
+    if not entrada or not entrada.get("zip"):
+        return None
+    cache = _cache_dir() / order_id / nome
+    if cache.is_file():
+        return cache
+    try:
+        with zipfile.ZipFile(store.ARCHIVE_DIR / entrada["zip"]) as zf:
+            data = zf.read(nome)
+    except (FileNotFoundError, KeyError):
+        return None
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_name(f"{cache.name}.{uuid.uuid4().hex}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, cache)
+    return cache
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Arquiva pedidos processados antigos na camada fria.")
+    parser.add_argument("--dias", type=int, default=int(os.getenv("ARCHIVE_AFTER_DAYS", "30")),
+                        help="idade mínima desde a conclusão (default: ARCHIVE_AFTER_DAYS ou 30)")
+    parser.add_argument("--limite", type=int, default=None, help="máximo de pedidos nesta execução")
+    parser.add_argument("--dry-run", action="store_true", help="só lista os pedidos elegíveis")
+    parser.add_argument("--limpar-cache", action="store_true", help="apaga arquivos extraídos sob demanda")
+    args = parser.parse_args(argv)
+
+    if args.limpar_cache:
+        shutil.rmtree(_cache_dir(), ignore_errors=True)
+    movidos = arquivar(args.dias, limite=args.limite, dry_run=args.dry_run)
+    acao = "elegíveis" if args.dry_run else "arquivados"
+    print(f"{len(movidos)} pedido(s) {acao}.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
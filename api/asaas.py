@@ -8,7 +8,10 @@ import store
 
 
 def _base_url() -> str:
-    """URL base da API: sandbox ou produção conforme ASAAS_PRODUCTION."""
+    """URL base da API: ASAAS_BASE_URL (ex.: fake local) ou sandbox/produção conforme ASAAS_PRODUCTION."""
+    override = os.getenv("ASAAS_BASE_URL", "").strip().rstrip("/")
+    if override:
+        return override
     prod = os.getenv("ASAAS_PRODUCTION", "false").lower() in ("true", "1")
     return "https://api.asaas.com" if prod else "https://api-sandbox.asaas.com"
 
@@ -0,0 +1,327 @@
+"""
+Backups online (sem parar a API) de pedidos e telemetria, incrementais e restauráveis por data.
+
+- Sem lock do store: cada arquivo é lido uma vez (hash e gzip no mesmo passo), e como o store grava
+  com troca atômica (os.replace) cada cópia é um estado inteiro do arquivo. Entre arquivos, a
+  consistência vem da ordem: orders.json primeiro, depois o índice da camada fria, depois o resto.
+  archive.py grava a camada fria antes de tirar os pedidos do orders.json, então um arquivamento no
+  meio do backup no máximo deixa um pedido nos dois lugares (get_order prefere o quente), nunca em nenhum.
+- telemetry.db (em WAL, ver telemetry.init_db) é copiado pela API de backup online do SQLite num
+  único passo: a leitura vê um instante do banco e não bloqueia quem grava eventos.
+- Cada arquivo vira um objeto gzip endereçado por SHA-256 em BACKUP_DIR/objects; cada snapshot é um
+  manifesto em BACKUP_DIR/snapshots/<UTC>.json. O manifesto guarda (tamanho, mtime_ns) de cada
+  arquivo: se os dois batem com o snapshot anterior (meses arquivados, zips, uploads), o arquivo nem é
+  lido e o objeto anterior é reaproveitado. Como toda gravação do store troca o arquivo, ela muda o mtime.
+- criar_snapshot e podar se excluem também entre processos (flock em BACKUP_DIR/backup.lock): a poda
+  apagaria objetos recém-guardados que ainda não estão em nenhum manifesto.
+
+Rode com: uv run backup.py criar [--com-uploads] [--manter N]
+          uv run backup.py listar
+          uv run backup.py restaurar --destino DIR [--ate 2026-10-19T12:00:00Z | --snapshot NOME]
+A restauração escreve DIR/data, DIR/uploads e DIR/telemetry.db (aponte PETSTORY_DATA_DIR,
+PETSTORY_UPLOADS_DIR e TELEMETRY_DB para eles, ou copie para o lugar com a API parada).
+
+Também há POST /admin/backup (header X-PetStory-Backup com BACKUP_TOKEN; sem token a rota responde 403).
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+import metrics
+import store
+import telemetry
+
+try:
+    import fcntl
+except ImportError:  # Windows: só o lock entre threads
+    fcntl = None
+
+load_dotenv()
+
+# Já comprimidos: gzip rápido (nível 1) só para manter um formato único de objeto.
+_COMPRIMIDOS = (".zip", ".png", ".jpg", ".jpeg", ".webp", ".pdf", ".gz")
+# Derivados, temporários e locks (.tmp, .lock): não entram no backup.
+_IGNORAR_DIRS = {"cache"}
+
+BACKUP_HEADER = "x-petstory-backup"
+
+_lock = threading.Lock()
+
+
+def backup_dir() -> Path:
+    raw = os.getenv("BACKUP_DIR", "").strip()
+    return Path(raw) if raw else Path(__file__).resolve().parent / "backups"
+
+
+def autorizado(header_value: str | None) -> bool:
+    """True se o header traz o BACKUP_TOKEN configurado. Sem BACKUP_TOKEN, sempre False."""
+    token = os.getenv("BACKUP_TOKEN", "").strip()
+    return bool(token) and (header_value or "").strip() == token
+
+
+@contextmanager
+def _exclusivo(esperar: bool):
+    """Lock entre threads + flock em BACKUP_DIR/backup.lock. Sem esperar, levanta RuntimeError se ocupado."""
+    if not _lock.acquire(blocking=esperar):
+        raise RuntimeError("Backup já em andamento")
+    try:
+        backup_dir().mkdir(parents=True, exist_ok=True)
+        with open(backup_dir() / "backup.lock", "a+b") as fd:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX if esperar else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise RuntimeError("Backup já em andamento") from None
+            yield  # fechar o arquivo solta o flock
+    finally:
+        _lock.release()
+
+
+def _objeto(digest: str) -> Path:
+    return backup_dir() / "objects" / digest[:2] / f"{digest}.gz"
+
+
+def _guardar(origem: Path) -> tuple[str, int, bool]:
+    """
+    Guarda o arquivo como objeto (se ainda não existir). Lê a origem uma única vez, calculando o
+    SHA-256 enquanto comprime, então o nome do objeto sempre bate com o conteúdo guardado.
+    Retorna (sha256, tamanho, novo).
+    """
+    objetos = backup_dir() / "objects"
+    objetos.mkdir(parents=True, exist_ok=True)
+    nivel = 1 if origem.suffix.lower() in _COMPRIMIDOS else 6
+    tmp = objetos / f"{uuid.uuid4().hex}.tmp"
+    h = hashlib.sha256()
+    tamanho = 0
+    try:
+        with open(origem, "rb") as src, gzip.open(tmp, "wb", compresslevel=nivel) as dst:
+            for bloco in iter(lambda: src.read(1024 * 1024), b""):
+                h.update(bloco)
+                tamanho += len(bloco)
+                dst.write(bloco)
+        digest = h.hexdigest()
+        destino = _objeto(digest)
+        if destino.exists():
+            return digest, tamanho, False
+        destino.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, destino)
+        return digest, tamanho, True
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def _arquivos(raiz: Path, prefixo: str) -> list[tuple[str, Path]]:
+    """(nome lógico, caminho) dos arquivos sob raiz, sem temporários e diretórios derivados."""
+    if not raiz.is_dir():
+        return []
+    itens = []
+    for path in sorted(raiz.rglob("*")):
+        rel = path.relative_to(raiz)
+        if not path.is_file() or path.suffix in (".tmp", ".lock") or _IGNORAR_DIRS & set(rel.parts[:-1]):
+            continue
+        if backup_dir() in path.parents:
+            continue
+        itens.append((f"{prefixo}/{rel.as_posix()}", path))
+    return itens
+
+
+def _copiar_sqlite(origem: Path, destino: Path) -> None:
+    """
+    Backup online do SQLite num único passo. Em passos, qualquer gravação de outra conexão
+    recomeça a cópia (e save_event grava o tempo todo); em WAL, um passo só não bloqueia escritores.
+    """
+    src = sqlite3.connect(str(origem))
+    dst = sqlite3.connect(str(destino))
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def criar_snapshot(com_uploads: bool = False) -> dict:
+    """
+    Cria um snapshot (pedidos, camada fria, lotes e telemetria; uploads se com_uploads).
+    Retorna o manifesto com estatísticas. Levanta RuntimeError se já houver backup (ou poda) em
+    andamento, neste ou em outro processo.
+    """
+    with _exclusivo(esperar=False), metrics.etapa("backup"):
+        return _criar_snapshot(com_uploads)
+
+
+def _ultimo_manifesto() -> dict:
+    pasta = backup_dir() / "snapshots"
+    ultimos = sorted(pasta.glob("*.json"))[-1:] if pasta.is_dir() else []
+    return json.loads(ultimos[0].read_text(encoding="utf-8")) if ultimos else {}
+
+
+def _criar_snapshot(com_uploads: bool) -> dict:
+    inicio = time.monotonic()
+    agora = datetime.utcnow()
+    anteriores = _ultimo_manifesto().get("arquivos", {})
+    arquivos: dict[str, dict] = {}
+    novos = 0
+    bytes_novos = 0
+
+    def guardar(nome: str, path: Path, reaproveitar: bool = True) -> None:
+        nonlocal novos, bytes_novos
+        try:
+            # stat antes de ler: se o arquivo for trocado no meio, o mtime gravado é o antigo e o
+            # próximo snapshot lê de novo.
+            st = path.stat()
+            antes = anteriores.get(nome) if reaproveitar else None
+            if (
+                antes and antes.get("tamanho") == st.st_size and antes.get("mtime_ns") == st.st_mtime_ns
+                and _objeto(antes["sha256"]).exists()
+            ):
+                arquivos[nome] = antes
+                return
+            digest, tamanho, novo = _guardar(path)
+        except FileNotFoundError:
+            return  # removido durante o backup (ex.: upload arquivado)
+        arquivos[nome] = {"sha256": digest, "tamanho": tamanho, "mtime_ns": st.st_mtime_ns}
+        novos += novo
+        bytes_novos += tamanho if novo else 0
+
+    # orders.json antes de listar o resto e o índice da camada fria antes dos arquivos mensais
+    # (ver docstring do módulo): um arquivamento concorrente duplica pedidos, não os perde.
+    guardar("data/orders.json", store.ORDERS_FILE)
+    resto = [i for i in _arquivos(store.DATA_DIR, "data") if i[0] != "data/orders.json"]
+    resto.sort(key=lambda i: i[0] != "data/archive/index.json")
+    if com_uploads:
+        resto += _arquivos(store.UPLOADS_DIR, "uploads")
+    for nome, path in resto:
+        guardar(nome, path)
+
+    if telemetry.TELEMETRY_DB.exists():
+        with tempfile.TemporaryDirectory() as tmp:
+            copia = Path(tmp) / "telemetry.db"
+            _copiar_sqlite(telemetry.TELEMETRY_DB, copia)
+            guardar("telemetry.db", copia, reaproveitar=False)  # cópia nova: mtime não diz nada
+
+    manifesto = {
+        "nome": agora.strftime("%Y%m%dT%H%M%S%fZ"),
+        "criado_em": agora.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "com_uploads": com_uploads,
+        "arquivos": arquivos,
+        "objetos_novos": novos,
+        "bytes_novos": bytes_novos,
+        "duracao_s": round(time.monotonic() - inicio, 3),
+    }
+    snapshots = backup_dir() / "snapshots"
+    snapshots.mkdir(parents=True, exist_ok=True)
+    destino = snapshots / f"{manifesto['nome']}.json"
+    tmp = destino.with_name(destino.name + ".tmp")
+    tmp.write_text(json.dumps(manifesto, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, destino)
+    return manifesto
+
+
+def listar() -> list[dict]:
+    """Manifestos de snapshots, do mais antigo ao mais recente."""
+    pasta = backup_dir() / "snapshots"
+    if not pasta.is_dir():
+        return []
+    return [json.loads(p.read_text(encoding="utf-8")) for p in sorted(pasta.glob("*.json"))]
+
+
+def _escolher(ate: str | None, nome: str | None) -> dict:
+    snapshots = listar()
+    if nome:
+        snapshots = [s for s in snapshots if s["nome"] == nome]
+    elif ate:
+        if len(ate) == 10:  # só a data: até o fim do dia
+            ate += "T23:59:59"
+        snapshots = [s for s in snapshots if s["criado_em"][:19] <= ate[:19]]
+    if not snapshots:
+        raise ValueError("Nenhum snapshot encontrado para o critério informado")
+    return snapshots[-1]
+
+
+def restaurar(destino: Path, ate: str | None = None, nome: str | None = None) -> dict:
+    """
+    Restaura em `destino` o snapshot pedido (por nome) ou o mais recente até `ate` (ISO UTC).
+    Confere o SHA-256 de cada arquivo. Retorna o manifesto usado.
+    """
+    manifesto = _escolher(ate, nome)
+    for logico, info in manifesto["arquivos"].items():
+        alvo = destino / logico
+        alvo.parent.mkdir(parents=True, exist_ok=True)
+        tmp = alvo.with_name(alvo.name + ".tmp")
+        h = hashlib.sha256()
+        with gzip.open(_objeto(info["sha256"]), "rb") as src, open(tmp, "wb") as dst:
+            for bloco in iter(lambda: src.read(1024 * 1024), b""):
+                h.update(bloco)
+                dst.write(bloco)
+        if h.hexdigest() != info["sha256"]:
+            tmp.unlink(missing_ok=True)
+            raise ValueError(f"Objeto corrompido para {logico}")
+        os.replace(tmp, alvo)
+    return manifesto
+
+
+def podar(manter: int) -> int:
+    """Mantém os `manter` snapshots mais recentes e apaga objetos não referenciados. Retorna objetos apagados."""
+    with _exclusivo(esperar=True):
+        return _podar(manter)
+
+
+def _podar(manter: int) -> int:
+    snapshots = listar()
+    pasta = backup_dir() / "snapshots"
+    for s in snapshots[:-manter] if manter > 0 else []:
+        (pasta / f"{s['nome']}.json").unlink(missing_ok=True)
+    usados = {info["sha256"] for s in listar() for info in s["arquivos"].values()}
+    apagados = 0
+    for obj in (backup_dir() / "objects").glob("*/*.gz"):
+        if obj.name[:-3] not in usados:
+            obj.unlink()
+            apagados += 1
+    return apagados
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Backups online de pedidos e telemetria.")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    p_criar = sub.add_parser("criar", help="cria um snapshot")
+    p_criar.add_argument("--com-uploads", action="store_true", help="inclui a pasta uploads")
+    p_criar.add_argument("--manter", type=int, default=0, help="depois, mantém só os N snapshots mais recentes")
+    sub.add_parser("listar", help="lista snapshots")
+    p_rest = sub.add_parser("restaurar", help="restaura um snapshot numa pasta")
+    p_rest.add_argument("--destino", type=Path, required=True)
+    grupo = p_rest.add_mutually_exclusive_group()
+    grupo.add_argument("--ate", help="snapshot mais recente até este instante (ISO UTC)")
+    grupo.add_argument("--snapshot", help="nome exato do snapshot")
+    args = parser.parse_args(argv)
+
+    if args.comando == "criar":
+        m = criar_snapshot(com_uploads=args.com_uploads)
+        print(f"Snapshot {m['nome']}: {len(m['arquivos'])} arquivo(s), {m['objetos_novos']} novo(s) "
+              f"({m['bytes_novos'] / 1024 / 1024:.1f} MB) em {m['duracao_s']:.1f}s")
+        if args.manter:
+            print(f"{podar(args.manter)} objeto(s) não referenciado(s) apagado(s)")
+    elif args.comando == "listar":
+        for m in listar():
+            print(f"{m['nome']}  {m['criado_em']}  arquivos={len(m['arquivos'])}  "
+                  f"novos={m['objetos_novos']}  uploads={'sim' if m['com_uploads'] else 'não'}")
+    else:
+        m = restaurar(args.destino, ate=args.ate, nome=args.snapshot)
+        print(f"Snapshot {m['nome']} ({m['criado_em']}) restaurado em {args.destino}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+Modo lote para backlog e pedidos sem pressa: em vez de uma chamada generate_content por imagem,
+agrupa as gerações pendentes de vários pedidos em batch jobs do Gemini (mais barato, sem disputar cota),
+acompanha até concluírem, grava as imagens nas pastas dos pedidos e finaliza cada pedido
+(PDF + email) com processar_pedido, que só refaz o que falta.
+
+Cada lote submetido tem um manifesto em data/batches/; gerações já em lote não são submetidas de novo
+nem geradas por process.py ou pela fila da API, e uma execução interrompida retoma coletando os lotes
+abertos (com GEMINI_BACKEND=google). Cada lote vai até --max-jobs gerações e LOTE_MAX_BYTES de payload
+(fotos reduzidas por referencia_lote).
+
+Rode com: uv run batch.py [--desde YYYY-MM-DD] [--ate ...] [--pedido ID] [--limite N]
+          [--max-jobs 50] [--intervalo 60] [--so-submeter | --so-coletar]
+"""
+import argparse
+import json
+import re
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import metrics
+import store
+from gemini import (
+    LOTE_CONCLUIDO,
+    LOTE_FALHOU,
+    LOTE_MAX_BYTES,
+    LOTE_PENDENTE,
+    backend,
+    referencia_lote,
+    tamanho_job_lote,
+)
+from mail import log_email
+from process import (
+    BATCHES_DIR,
+    Geracao,
+    concluir_geracao,
+    destinos_em_lote,
+    filtrar_pedidos,
+    geracoes_pendentes,
+    gravar_atomico,
+    manifestos_lote,
+    novo_dono,
+    processar_pedido,
+)
+
+MAX_JOBS_POR_LOTE = 50
+
+
+def _submeter_grupo(grupo: list[tuple[str, Geracao, bytes]]) -> str:
+    """Submete um lote de (order_id, geração, referência) e grava seu manifesto. Retorna o id."""
+    b = backend()
+    nome = f"petstory-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    lote_id = b.submeter_lote([(ref, g.prompt) for _, g, ref in grupo], nome)
+    manifesto = {
+        "lote_id": lote_id,
+        "backend": b.nome,
+        "submetido_em": datetime.utcnow().isoformat() + "Z",
+        "jobs": [{"order_id": oid, "destino": str(g.destino), "tema": g.tema} for oid, g, _ in grupo],
+    }
+    path = BATCHES_DIR / f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', lote_id)}.json"
+    gravar_atomico(path, json.dumps(manifesto, ensure_ascii=False, indent=2).encode("utf-8"))
+    metrics.GEMINI_BATCH_JOBS.inc(len(grupo), resultado="submetido")
+    print(f"Lote {lote_id}: {len(grupo)} geração(ões) submetida(s).", file=sys.stderr)
+    return lote_id
+
+
+def submeter(pedidos: list[dict], max_jobs: int = MAX_JOBS_POR_LOTE, max_bytes: int = LOTE_MAX_BYTES) -> list[str]:
+    """
+    Submete as gerações pendentes dos pedidos (fora de lotes abertos) em lotes de até max_jobs
+    gerações e max_bytes de payload estimado. Pedidos reivindicados por outro processo (process.py,
+    fila da API) ficam de fora; os demais ficam reivindicados até seus manifestos estarem gravados.
+    Retorna os ids dos lotes.
+    """
+    BATCHES_DIR.mkdir(parents=True, exist_ok=True)
+    lotes: list[str] = []
+    grupo: list[tuple[str, Geracao, bytes]] = []
+    tamanho = 0
+    foto_atual, ref = None, b""  # as gerações de uma foto vêm seguidas: reduz cada foto uma vez
+    dono = novo_dono()
+    reivindicados: list[str] = []
+    try:
+        for pedido in pedidos:
+            if not store.claim_order(pedido["order_id"], dono):
+                print(f"{pedido['order_id']}: em processamento em outro lugar, fora do lote.", file=sys.stderr)
+                continue
+            reivindicados.append(pedido["order_id"])
+            for g in geracoes_pendentes(pedido):
+                if g.foto != foto_atual:
+                    foto_atual, ref = g.foto, referencia_lote(g.foto.read_bytes())
+                t = tamanho_job_lote(ref, g.prompt)
+                if grupo and (len(grupo) >= max_jobs or tamanho + t > max_bytes):
+                    lotes.append(_submeter_grupo(grupo))
+                    grupo, tamanho = [], 0
+                grupo.append((pedido["order_id"], g, ref))
+                tamanho += t
+        if grupo:
+            lotes.append(_submeter_grupo(grupo))
+    finally:
+        for order_id in reivindicados:
+            store.release_order(order_id, dono)
+    return lotes
+
+
+def coletar() -> int:
+    """Consulta lotes abertos; grava resultados dos concluídos e descarta os que falharam. Retorna lotes abertos restantes."""
+    b = backend()
+    abertos = 0
+    for path, manifesto in manifestos_lote():
+        if manifesto["backend"] != b.nome:
+            continue
+        lote_id = manifesto["lote_id"]
+        estado = b.estado_lote(lote_id)
+        if estado == LOTE_PENDENTE:
+            abertos += 1
+            continue
+        if estado == LOTE_CONCLUIDO:
+            resultados = b.resultados_lote(lote_id)
+            for i, job in enumerate(manifesto["jobs"]):
+                resultado = resultados[i] if i < len(resultados) else ValueError("sem resposta no lote")
+                if isinstance(resultado, bytes):
+                    concluir_geracao(Path(job["destino"]), resultado)
+                    metrics.GEMINI_BATCH_JOBS.inc(resultado="ok")
+                else:
+                    metrics.GEMINI_BATCH_JOBS.inc(resultado="falha")
+                    log_email(f"Pedido {job['order_id']} - falha no lote {lote_id} ({job['tema']}): {resultado}")
+        elif estado == LOTE_FALHOU:
+            metrics.GEMINI_BATCH_JOBS.inc(len(manifesto["jobs"]), resultado="falha")
+            log_email(f"Lote {lote_id} falhou; {len(manifesto['jobs'])} geração(ões) voltam a ficar pendentes")
+        # Gerações sem imagem voltam a ser pendentes e entram no próximo submeter.
+        path.unlink(missing_ok=True)
+    return abertos
+
+
+def drenar(pedidos: list[dict], max_jobs: int = MAX_JOBS_POR_LOTE, intervalo: float = 60.0) -> int:
+    """Submete, espera os lotes e finaliza os pedidos com todas as imagens. Retorna pedidos não concluídos."""
+    submeter(pedidos, max_jobs)
+    while coletar():
+        time.sleep(intervalo)
+    return _finalizar(pedidos)
+
+
+def _finalizar(pedidos: list[dict]) -> int:
+    """Roda processar_pedido (PDF + email) nos pedidos sem geração pendente. Retorna quantos ficaram de fora ou falharam."""
+    restantes = 0
+    em_lote = destinos_em_lote()
+    for pedido in pedidos:
+        pendentes = geracoes_pendentes(pedido, incluir_em_lote=True)
+        if pendentes:
+            restantes += 1
+            aguardando = sum(str(g.destino) in em_lote for g in pendentes)
+            print(f"{pedido['order_id']}: {len(pendentes)} geração(ões) pendente(s), {aguardando} em lote.",
+                  file=sys.stderr)
+            continue
+        if not processar_pedido(pedido):
+            restantes += 1
+    return restantes
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Gera imagens de pedidos pendentes via batch jobs do Gemini.")
+    parser.add_argument("--pedido", action="append", dest="ids", metavar="ORDER_ID")
+    parser.add_argument("--desde", metavar="YYYY-MM-DD")
+    parser.add_argument("--ate", metavar="YYYY-MM-DD")
+    parser.add_argument("--limite", type=int, default=None)
+    parser.add_argument("--max-jobs", type=int, default=MAX_JOBS_POR_LOTE, help="gerações por lote")
+    parser.add_argument("--intervalo", type=float, default=60.0, help="segundos entre consultas aos lotes")
+    modo = parser.add_mutually_exclusive_group()
+    modo.add_argument("--so-submeter", action="store_true", help="submete e sai (coletar depois)")
+    modo.add_argument("--so-coletar", action="store_true",
+                      help="coleta lotes prontos e finaliza pedidos completos, sem esperar nem submeter")
+    args = parser.parse_args(argv)
+
+    pedidos = filtrar_pedidos(store.list_pending_production(), args.ids, args.desde, args.ate, args.limite)
+    if args.so_submeter:
+        submeter(pedidos, args.max_jobs)
+        return 0
+    if args.so_coletar:
+        abertos = coletar()
+        print(f"{abertos} lote(s) ainda em andamento.", file=sys.stderr)
+        return 1 if _finalizar(pedidos) else 0
+    return 1 if drenar(pedidos, args.max_jobs, args.intervalo) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,294 @@
+"""
+Servidores locais que substituem Asaas, Gemini e SMTP em testes de carga (loadtest.py).
+Só stdlib: cada fake roda em thread própria e registra o que recebeu.
+
+A API aponta para eles via ASAAS_BASE_URL, GEMINI_BASE_URL e SMTP_SERVER/SMTP_PORT
+(com SMTP_STARTTLS=false).
+"""
+import base64
+import json
+import random
+import socketserver
+import struct
+import threading
+import time
+import urllib.request
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def png_bytes(width: int = 256, height: int = 256, seed: int = 0) -> bytes:
+    """
+    PNG em tons de cinza sem depender do Pillow: moldura preta e uma grade 8x8 de blocos pretos ou
+    brancos sorteados pela seed. Seeds diferentes dão fotos bem distintas para o phash (dHash a
+    20+ bits de distância, longe do PHASH_THRESHOLD), então o teste de carga não vira "rajada".
+    """
+    rng = random.Random(seed)
+    borda = max(2, min(width, height) // 32)
+    blocos = [[rng.random() < 0.5 for _ in range(8)] for _ in range(8)]
+    linhas = bytearray()
+    for y in range(height):
+        linhas.append(0)  # filtro None
+        for x in range(width):
+            preto = (
+                x < borda or y < borda or x >= width - borda or y >= height - borda
+                or blocos[y * 8 // height][x * 8 // width]
+            )
+            linhas.append(0 if preto else 255)
+
+    def chunk(tipo: bytes, dados: bytes) -> bytes:
+        corpo = tipo + dados
+        return struct.pack(">I", len(dados)) + corpo + struct.pack(">I", zlib.crc32(corpo) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", ihdr)
+        + chunk(b"IDAT", zlib.compress(bytes(linhas), 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+class _Latencia:
+    """Latência simulada: média + jitter uniforme, em segundos."""
+
+    def __init__(self, media: float, jitter: float = 0.0):
+        self.media = media
+        self.jitter = jitter
+
+    def dormir(self) -> None:
+        atraso = self.media + random.uniform(-self.jitter, self.jitter)
+        if atraso > 0:
+            time.sleep(atraso)
+
+
+class _HttpFake:
+    """Base: ThreadingHTTPServer em 127.0.0.1 numa porta livre, rodando em thread daemon."""
+
+    def __init__(self):
+        self._server: ThreadingHTTPServer | None = None
+        self._thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        raise NotImplementedError
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "_HttpFake":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _responder_json(handler: BaseHTTPRequestHandler, status: int, data: dict) -> None:
+    corpo = json.dumps(data).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(corpo)))
+    handler.end_headers()
+    handler.wfile.write(corpo)
+
+
+class FakeAsaas(_HttpFake):
+    """POST /v3/checkouts: registra externalReference e devolve um id de checkout."""
+
+    def __init__(self, latencia: float = 0.2, jitter: float = 0.05):
+        super().__init__()
+        self.latencia = _Latencia(latencia, jitter)
+        self.checkouts: dict[str, str] = {}  # checkout_id -> order_id
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                tamanho = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(tamanho) or b"{}")
+                if self.path.rstrip("/") != "/v3/checkouts":
+                    _responder_json(self, 404, {"errors": [{"description": "not found"}]})
+                    return
+                fake.latencia.dormir()
+                checkout_id = f"chk_{uuid.uuid4().hex}"
+                with fake.lock:
+                    fake.checkouts[checkout_id] = payload.get("externalReference", "")
+                _responder_json(self, 200, {"id": checkout_id})
+
+        return Handler
+
+    def order_id(self, checkout_id: str) -> str | None:
+        with self.lock:
+            return self.checkouts.get(checkout_id)
+
+
+def enviar_webhook_pago(api_url: str, checkout_id: str, token: str = "", timeout: float = 30) -> int:
+    """Envia à API um evento CHECKOUT_PAID como o Asaas faria. Retorna o status HTTP."""
+    corpo = json.dumps({"event": "CHECKOUT_PAID", "checkout": {"id": checkout_id}}).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["asaas-access-token"] = token
+    req = urllib.request.Request(
+        f"{api_url.rstrip('/')}/webhook/asaas", data=corpo, headers=headers, method="POST"
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return resp.status
+
+
+class FakeGemini(_HttpFake):
+    """Responde a qualquer POST .../models/<modelo>:generateContent com um PNG inline."""
+
+    def __init__(self, latencia: float = 2.0, jitter: float = 0.5, taxa_erro: float = 0.0):
+        super().__init__()
+        self.latencia = _Latencia(latencia, jitter)
+        self.taxa_erro = taxa_erro
+        self.chamadas = 0
+        self._png_b64 = base64.b64encode(png_bytes(512, 512, seed=1)).decode("ascii")
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                tamanho = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(tamanho)
+                if not self.path.split("?")[0].endswith(":generateContent"):
+                    _responder_json(self, 404, {"error": {"code": 404, "message": "not found"}})
+                    return
+                with fake.lock:
+                    fake.chamadas += 1
+                fake.latencia.dormir()
+                if fake.taxa_erro and random.random() < fake.taxa_erro:
+                    _responder_json(self, 429, {
+                        "error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}
+                    })
+                    return
+                _responder_json(self, 200, {
+                    "candidates": [{
+                        "content": {
+                            "role": "model",
+                            "parts": [{"inlineData": {"mimeType": "image/png", "data": fake._png_b64}}],
+                        },
+                        "finishReason": "STOP",
+                    }],
+                })
+
+        return Handler
+
+
+class _SmtpServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SmtpSink:
+    """
+    Servidor SMTP mínimo (EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA, QUIT) sem TLS.
+    Aceita qualquer credencial e guarda (instante, assunto, tamanho) de cada mensagem.
+    """
+
+    def __init__(self, latencia: float = 0.05):
+        self.latencia = _Latencia(latencia)
+        self.lock = threading.Lock()
+        self.mensagens: list[tuple[float, str, int]] = []
+        self._server: _SmtpServer | None = None
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler(self):
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def _send(self, linha: str) -> None:
+                self.wfile.write((linha + "\r\n").encode("ascii"))
+
+            def handle(self):
+                self._send("220 petstory-sink ESMTP")
+                while True:
+                    raw = self.rfile.readline()
+                    if not raw:
+                        return
+                    cmd = raw.decode("utf-8", "replace").strip()
+                    verbo = cmd.split(" ", 1)[0].upper()
+                    if verbo in ("EHLO", "HELO"):
+                        self._send("250-petstory-sink")
+                        self._send("250-AUTH PLAIN LOGIN")
+                        self._send("250 8BITMIME")
+                    elif verbo == "AUTH":
+                        partes = cmd.split()
+                        if len(partes) >= 2 and partes[1].upper() == "LOGIN":
+                            # usuário e senha em duas rodadas base64
+                            for _ in range(2 if len(partes) == 2 else 1):
+                                self._send("334 VXNlcm5hbWU6")
+                                self.rfile.readline()
+                        elif len(partes) == 2:
+                            self._send("334 ")
+                            self.rfile.readline()
+                        self._send("235 2.7.0 Authentication successful")
+                    elif verbo in ("MAIL", "RCPT", "RSET", "NOOP"):
+                        self._send("250 OK")
+                    elif verbo == "DATA":
+                        self._send("354 End data with <CR><LF>.<CR><LF>")
+                        self._receber_dados()
+                    elif verbo == "QUIT":
+                        self._send("221 Bye")
+                        return
+                    else:
+                        self._send("502 Command not implemented")
+
+            def _receber_dados(self) -> None:
+                assunto = ""
+                tamanho = 0
+                while True:
+                    linha = self.rfile.readline()
+                    if not linha or linha in (b".\r\n", b".\n"):
+                        break
+                    tamanho += len(linha)
+                    if not assunto and linha[:8].lower() == b"subject:":
+                        assunto = linha[8:].decode("utf-8", "replace").strip()
+                sink.latencia.dormir()
+                with sink.lock:
+                    sink.mensagens.append((time.time(), assunto, tamanho))
+                self._send("250 OK: queued")
+
+        return Handler
+
+    def start(self) -> "SmtpSink":
+        self._server = _SmtpServer(("127.0.0.1", 0), self._handler())
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def entregue_em(self, order_id: str) -> float | None:
+        """Instante (time.time) em que chegou o email do pedido, ou None."""
+        with self.lock:
+            for instante, assunto, _ in self.mensagens:
+                if order_id in assunto:
+                    return instante
+        return None
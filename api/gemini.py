@@ -1,16 +1,24 @@
 """
 Geração de imagem estilo livro de colorir via API Gemini (SDK google-genai).
 Key e model vêm do .env (GEMINI_API_KEY, GEMINI_MODEL).
+GEMINI_BACKEND escolhe o backend: google (default) ou local (stand-in sem rede, para testes).
+Ambos expõem gerar() síncrono e submeter_lote/estado_lote/resultados_lote (modo lote, batch.py).
 """
 import io
+import json
 import os
+import shutil
 import tempfile
 import time
+import uuid
 
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-from PIL import Image
+from PIL import Image, ImageFilter, ImageOps
+
+import profiling
+import store
 
 load_dotenv()
 
@@ -49,47 +57,84 @@ TEMAS_AVENTURA_V1 = [
 ]
 
 
+def _prompt_cena(cena: str, personagem: str, elementos: str) -> str:
+    """Prompt de aventura no mesmo formato dos temas v1."""
+    return (
+        "Using this pet photo as reference, create a single coloring book line art illustration. "
+        f"The pet must be the protagonist: draw the pet as {cena}.\n\n"
+        "STYLE: Same as a coloring book. Black-and-white outline only. Smooth black lines, medium-to-thick. "
+        "No shading, no gradients, no gray. Pure white background. The pet should remain recognizable (same animal, simplified). "
+        f"Keep the scene fun and clear. One pet character as {personagem}, simple {elementos}."
+    )
+
+
+# Temas extras: usados para fotos quase iguais do mesmo pedido (phash), em vez de repetir as cenas v1.
+TEMAS_AVENTURA_EXTRAS = [
+    ("pirate", _prompt_cena(
+        "a pirate captain on a ship (e.g. pirate hat, treasure map, sails and waves in background)",
+        "pirate", "ship and sea elements")),
+    ("explorer", _prompt_cena(
+        "a jungle explorer (e.g. explorer hat, binoculars, big leaves and vines in background)",
+        "explorer", "jungle elements")),
+    ("chef", _prompt_cena(
+        "a chef cooking in a kitchen (e.g. chef hat, apron, pots and vegetables around)",
+        "chef", "kitchen elements")),
+    ("knight", _prompt_cena(
+        "a brave knight (e.g. helmet, shield, small castle in background)",
+        "knight", "castle elements")),
+    ("diver", _prompt_cena(
+        "a deep-sea diver exploring the ocean (e.g. diving mask, bubbles, fish and corals around)",
+        "diver", "underwater elements")),
+    ("firefighter", _prompt_cena(
+        "a firefighter on duty (e.g. firefighter helmet, hose, fire truck in background)",
+        "firefighter", "fire station elements")),
+    ("wizard", _prompt_cena(
+        "a wizard casting a spell (e.g. pointy hat, magic wand, stars and spell book around)",
+        "wizard", "magical elements")),
+    ("cowboy", _prompt_cena(
+        "a cowboy in the wild west (e.g. cowboy hat, bandana, cactus and desert hills in background)",
+        "cowboy", "desert elements")),
+]
+TEMAS_AVENTURA = TEMAS_AVENTURA_V1 + TEMAS_AVENTURA_EXTRAS
+
+
 def prompt_aventura(tema_id: str, pet_name: str) -> str:
     """Retorna o prompt de aventura para o tema. pet_name pode ser usado em frases futuras."""
-    for tid, prompt in TEMAS_AVENTURA_V1:
+    for tid, prompt in TEMAS_AVENTURA:
         if tid == tema_id:
             return prompt
     raise ValueError(f"Tema desconhecido: {tema_id}")
 
 
-def gerar_imagem(image_bytes: bytes, prompt: str) -> bytes:
-    """
-    Gera imagem a partir de foto (bytes) e prompt. Retorna PNG em bytes.
-    Levanta ValueError se key/model faltando ou se a resposta não contiver imagem.
-    """
+def _modelo() -> tuple[str, str]:
+    """(api_key, model_name) do .env. Levanta ValueError se faltar algum."""
     api_key = os.getenv("GEMINI_API_KEY", "").strip()
     model_name = os.getenv("GEMINI_MODEL", "").strip()
     if not api_key or not model_name:
         raise ValueError("GEMINI_API_KEY e GEMINI_MODEL devem estar definidos no .env")
     if not model_name.startswith("models/"):
         model_name = f"models/{model_name}"
+    return api_key, model_name
 
-    client = genai.Client(api_key=api_key)
-    image = Image.open(io.BytesIO(image_bytes))
-    if image.mode != "RGB":
-        image = image.convert("RGB")
 
-    max_retries = 2
-    for attempt in range(max_retries):
-        try:
-            response = client.models.generate_content(
-                model=model_name,
-                contents=[prompt, image],
-            )
-            break
-        except Exception as e:
-            if "quota" in str(e).lower() or "resource_exhausted" in str(e).lower():
-                if attempt < max_retries - 1:
-                    time.sleep(5)
-                    continue
-            raise
-
-    for part in response.parts:
+def _client(api_key: str) -> genai.Client:
+    base_url = os.getenv("GEMINI_BASE_URL", "").strip()
+    if base_url:
+        return genai.Client(api_key=api_key, http_options=types.HttpOptions(base_url=base_url))
+    return genai.Client(api_key=api_key)
+
+
+def _imagem_rgb(image_bytes: bytes) -> Image.Image:
+    with profiling.span("pillow_decode"):
+        image = Image.open(io.BytesIO(image_bytes))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+    return image
+
+
+def _png_da_resposta(parts) -> bytes:
+    """Primeira imagem inline das parts da resposta, como PNG. Levanta ValueError se não houver."""
+    for part in parts or []:
         if part.text is not None:
             continue
         if part.inline_data is not None:
@@ -97,10 +142,196 @@ def gerar_imagem(image_bytes: bytes, prompt: str) -> bytes:
             with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
                 tmp_path = f.name
             try:
-                image.save(tmp_path)
+                with profiling.span("png_encode"):
+                    image.save(tmp_path)
                 with open(tmp_path, "rb") as f:
                     return f.read()
             finally:
                 os.unlink(tmp_path)
 
     raise ValueError("Nenhuma imagem encontrada na resposta do Gemini")
+
+
+# Estados de lote devolvidos por estado_lote().
+LOTE_PENDENTE = "pendente"
+LOTE_CONCLUIDO = "concluido"
+LOTE_FALHOU = "falhou"
+
+# Modo lote: cada job leva a foto inline, então ela vai reduzida (lado maior LOTE_LADO_MAX_PX, JPEG).
+LOTE_LADO_MAX_PX = 1536
+LOTE_JPEG_QUALIDADE = 85
+# Teto do payload de um lote inline (a API limita o tamanho total da requisição; base64 infla ~4/3).
+LOTE_MAX_BYTES = 15 * 1024 * 1024
+
+
+def referencia_lote(image_bytes: bytes) -> bytes:
+    """Foto reduzida em JPEG para ir inline num job de lote (submeter_lote)."""
+    image = _imagem_rgb(image_bytes)
+    image.thumbnail((LOTE_LADO_MAX_PX, LOTE_LADO_MAX_PX), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=LOTE_JPEG_QUALIDADE)
+    return buf.getvalue()
+
+
+def tamanho_job_lote(referencia: bytes, prompt: str) -> int:
+    """Estimativa dos bytes que um job ocupa na requisição inline (imagem em base64 + prompt + envelope)."""
+    return (len(referencia) + 2) // 3 * 4 + len(prompt.encode("utf-8")) + 512
+
+
+class GoogleBackend:
+    """Gemini real (SDK google-genai): generate_content síncrono e Batch API com requisições inline."""
+
+    nome = "google"
+
+    def gerar(self, image_bytes: bytes, prompt: str) -> bytes:
+        api_key, model_name = _modelo()
+        client = _client(api_key)
+        image = _imagem_rgb(image_bytes)
+
+        max_retries = 2
+        for attempt in range(max_retries):
+            try:
+                with profiling.span("gemini_generate_content", attempt=attempt):
+                    response = client.models.generate_content(
+                        model=model_name,
+                        contents=[prompt, image],
+                    )
+                break
+            except Exception as e:
+                if "quota" in str(e).lower() or "resource_exhausted" in str(e).lower():
+                    if attempt < max_retries - 1:
+                        time.sleep(5)
+                        continue
+                raise
+
+        return _png_da_resposta(response.parts)
+
+    def submeter_lote(self, jobs: list[tuple[bytes, str]], nome: str) -> str:
+        """
+        Submete (referência, prompt) como um batch job inline; referência é o JPEG de referencia_lote().
+        Quem monta o lote respeita LOTE_MAX_BYTES (ver tamanho_job_lote). Retorna o id do job.
+        """
+        api_key, model_name = _modelo()
+        client = _client(api_key)
+        requests = [
+            {
+                "contents": [types.Content(role="user", parts=[
+                    types.Part.from_text(text=prompt),
+                    types.Part.from_bytes(data=referencia, mime_type="image/jpeg"),
+                ])],
+            }
+            for referencia, prompt in jobs
+        ]
+        job = client.batches.create(model=model_name, src=requests, config={"display_name": nome})
+        return job.name
+
+    def estado_lote(self, lote_id: str) -> str:
+        api_key, _ = _modelo()
+        job = _client(api_key).batches.get(name=lote_id)
+        estado = job.state.name if job.state else ""
+        if estado == "JOB_STATE_SUCCEEDED":
+            return LOTE_CONCLUIDO
+        if estado in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            return LOTE_FALHOU
+        return LOTE_PENDENTE
+
+    def resultados_lote(self, lote_id: str) -> list[bytes | Exception]:
+        """Um item por job, na ordem de submissão: PNG em bytes ou a exceção daquele job."""
+        api_key, _ = _modelo()
+        job = _client(api_key).batches.get(name=lote_id)
+        resultados: list[bytes | Exception] = []
+        for item in (job.dest.inlined_responses if job.dest else None) or []:
+            if item.error is not None or item.response is None:
+                resultados.append(ValueError(f"Gemini batch: {item.error}"))
+                continue
+            try:
+                resultados.append(_png_da_resposta(item.response.parts))
+            except ValueError as e:
+                resultados.append(e)
+        return resultados
+
+
+class LocalBackend:
+    """
+    Stand-in local, sem rede: devolve um "line art" feito com Pillow (bordas da foto) após
+    GEMINI_LOCAL_LATENCY segundos. Lotes ficam prontos GEMINI_LOCAL_BATCH_SECONDS após a submissão;
+    o estado de cada lote fica em store.BATCHES_DIR/local/<lote>/ (fotos + estado.json), então
+    batch.py --so-submeter e --so-coletar podem rodar em processos diferentes, como com o Google.
+    """
+
+    nome = "local"
+
+    @staticmethod
+    def _pasta(lote_id: str) -> Path:
+        return store.BATCHES_DIR / "local" / lote_id.rsplit("/", 1)[-1]
+
+    def _line_art(self, image_bytes: bytes) -> bytes:
+        bordas = _imagem_rgb(image_bytes).convert("L").filter(ImageFilter.FIND_EDGES)
+        linhas = ImageOps.invert(bordas).point(lambda v: 255 if v > 200 else 0)
+        buf = io.BytesIO()
+        linhas.save(buf, format="PNG")
+        return buf.getvalue()
+
+    def gerar(self, image_bytes: bytes, prompt: str) -> bytes:
+        time.sleep(float(os.getenv("GEMINI_LOCAL_LATENCY", "0") or 0))
+        return self._line_art(image_bytes)
+
+    def submeter_lote(self, jobs: list[tuple[bytes, str]], nome: str) -> str:
+        lote_id = f"local-batches/{nome}-{uuid.uuid4().hex[:8]}"
+        pasta = self._pasta(lote_id)
+        pasta.mkdir(parents=True)
+        for i, (referencia, _) in enumerate(jobs):
+            (pasta / f"job_{i}.jpg").write_bytes(referencia)
+        estado = {
+            "pronto_em": time.time() + float(os.getenv("GEMINI_LOCAL_BATCH_SECONDS", "2") or 0),
+            "prompts": [prompt for _, prompt in jobs],
+        }
+        # estado.json por último: lote sem ele é submissão interrompida (estado_lote: falhou).
+        (pasta / "estado.json").write_text(json.dumps(estado), encoding="utf-8")
+        return lote_id
+
+    def _estado(self, lote_id: str) -> dict | None:
+        try:
+            return json.loads((self._pasta(lote_id) / "estado.json").read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+
+    def estado_lote(self, lote_id: str) -> str:
+        estado = self._estado(lote_id)
+        if estado is None:
+            return LOTE_FALHOU
+        return LOTE_CONCLUIDO if time.time() >= estado["pronto_em"] else LOTE_PENDENTE
+
+    def resultados_lote(self, lote_id: str) -> list[bytes | Exception]:
+        estado = self._estado(lote_id)
+        if estado is None:
+            return []
+        pasta = self._pasta(lote_id)
+        resultados: list[bytes | Exception] = [
+            self._line_art((pasta / f"job_{i}.jpg").read_bytes()) for i in range(len(estado["prompts"]))
+        ]
+        shutil.rmtree(pasta, ignore_errors=True)
+        return resultados
+
+
+_BACKENDS = {"google": GoogleBackend, "local": LocalBackend}
+_backend = None
+
+
+def backend():
+    """Backend de geração conforme GEMINI_BACKEND (google | local); instância única por processo."""
+    global _backend
+    nome = os.getenv("GEMINI_BACKEND", "google").strip().lower() or "google"
+    if _backend is None or _backend.nome != nome:
+        if nome not in _BACKENDS:
+            raise ValueError(f"GEMINI_BACKEND desconhecido: {nome}")
+        _backend = _BACKENDS[nome]()
+    return _backend
+
+
+def gerar_imagem(image_bytes: bytes, prompt: str) -> bytes:
+    """
+    Gera imagem a partir de foto (bytes) e prompt. Retorna PNG em bytes.
+    Levanta ValueError se key/model faltando ou se a resposta não contiver imagem.
+    """
+    return backend().gerar(image_bytes, prompt)
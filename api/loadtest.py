@@ -0,0 +1,338 @@
+"""
+Teste de carga ponta a ponta, offline: sobe a API (uvicorn) com dados em pasta temporária,
+apontando para Asaas, Gemini e SMTP falsos (fakes.py), e simula clientes:
+beacons de telemetria, POST /pet, webhook CHECKOUT_PAID, polling de GET /order até o email chegar.
+
+Relata vazão e p50/p95/p99 por endpoint e o tempo pago -> email. Baselines salvos em
+loadtest_baselines/<nome>.json permitem detectar regressões (--comparar; sai com código 1).
+
+Rode com: uv run loadtest.py --pedidos 20 --usuarios 5 [--salvar-baseline local] [--comparar local]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import fakes
+
+API_DIR = Path(__file__).resolve().parent
+BASELINES_DIR = API_DIR / "loadtest_baselines"
+WEBHOOK_TOKEN = "loadtest-token"
+E2E = "pago->email"
+
+
+class Coletor:
+    """Acumula latências (s) e erros por endpoint, thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias: dict[str, list[float]] = {}
+        self.erros: dict[str, int] = {}
+
+    def registrar(self, endpoint: str, segundos: float, ok: bool = True) -> None:
+        with self._lock:
+            self.latencias.setdefault(endpoint, []).append(segundos)
+            if not ok:
+                self.erros[endpoint] = self.erros.get(endpoint, 0) + 1
+
+    def resumo(self, duracao: float) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    "n": len(valores),
+                    "erros": self.erros.get(endpoint, 0),
+                    "rps": round(len(valores) / duracao, 3) if duracao > 0 else 0.0,
+                    "p50": _percentil(valores, 50),
+                    "p95": _percentil(valores, 95),
+                    "p99": _percentil(valores, 99),
+                }
+                for endpoint, valores in sorted(self.latencias.items())
+            }
+
+
+def _percentil(valores: list[float], p: float) -> float:
+    """Percentil por nearest-rank, em segundos (0 se vazio)."""
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    idx = max(0, min(len(ordenados) - 1, math.ceil(p / 100 * len(ordenados)) - 1))
+    return round(ordenados[idx], 4)
+
+
+def _porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _multipart(campos: dict[str, str], arquivos: list[tuple[str, str, bytes]]) -> tuple[bytes, str]:
+    """Codifica multipart/form-data. arquivos = [(campo, nome_arquivo, bytes)]."""
+    boundary = uuid.uuid4().hex
+    partes: list[bytes] = []
+    for nome, valor in campos.items():
+        partes.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{nome}"\r\n\r\n{valor}\r\n'.encode("utf-8")
+        )
+    for campo, filename, conteudo in arquivos:
+        partes.append(
+            (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{campo}"; filename="{filename}"\r\n'
+                "Content-Type: image/png\r\n\r\n"
+            ).encode("utf-8")
+            + conteudo
+            + b"\r\n"
+        )
+    partes.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(partes), f"multipart/form-data; boundary={boundary}"
+
+
+class Cliente:
+    """Cliente HTTP simples (urllib) que registra cada chamada no coletor."""
+
+    def __init__(self, base_url: str, coletor: Coletor):
+        self.base_url = base_url.rstrip("/")
+        self.coletor = coletor
+
+    def chamar(self, endpoint: str, method: str, path: str, body: bytes | None = None,
+               headers: dict | None = None, timeout: float = 60) -> tuple[int, dict]:
+        req = urllib.request.Request(
+            self.base_url + path, data=body, headers=headers or {}, method=method
+        )
+        inicio = time.perf_counter()
+        status, data = 0, {}
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                status = resp.status
+                data = json.loads(resp.read() or b"{}")
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except (urllib.error.URLError, TimeoutError, ConnectionError):
+            status = 0
+        self.coletor.registrar(endpoint, time.perf_counter() - inicio, ok=200 <= status < 300)
+        return status, data
+
+    def beacon(self, session_id: str, event_name: str, metadata: dict | None = None) -> None:
+        evento = {
+            "session_id": session_id,
+            "event_name": event_name,
+            "path": "/",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "user_agent": "Mozilla/5.0 (X11; Linux x86_64) loadtest",
+            "screen_width": 1280,
+            "screen_height": 800,
+            "metadata": metadata or {},
+        }
+        self.chamar(
+            "POST /telemetry/event", "POST", "/telemetry/event",
+            json.dumps(evento).encode("utf-8"), {"Content-Type": "application/json"},
+        )
+
+
+def _jornada(n: int, cliente: Cliente, asaas: fakes.FakeAsaas, sink: fakes.SmtpSink,
+             args: argparse.Namespace) -> None:
+    """Uma compra completa: visita, upload, pagamento, polling até o email."""
+    rng = random.Random(args.seed + n)
+    sessao = uuid.uuid4().hex
+    cliente.beacon(sessao, "page_view")
+    for profundidade in (25, 50, 75, 100)[: rng.randint(1, 4)]:
+        cliente.beacon(sessao, f"scroll_{profundidade}")
+
+    n_fotos = rng.randint(1, args.fotos_max)
+    arquivos = [
+        ("pet-file", f"foto_{i}.png", fakes.png_bytes(args.foto_px, args.foto_px, seed=n * 10 + i))
+        for i in range(n_fotos)
+    ]
+    corpo, content_type = _multipart(
+        {"pet-name": f"Pet {n}", "user-email": f"cliente{n}@loadtest.invalid"}, arquivos
+    )
+    status, data = cliente.chamar(
+        "POST /pet", "POST", "/pet", corpo, {"Content-Type": content_type}, timeout=120
+    )
+    cliente.beacon(sessao, "form_submit", {"ok": status == 200})
+    if status != 200:
+        return
+    query = urllib.parse.urlparse(data.get("checkout_url", "")).query
+    checkout_id = urllib.parse.parse_qs(query).get("id", [""])[0]
+    order_id = asaas.order_id(checkout_id)
+    if not order_id:
+        return
+
+    # Cliente paga após alguns segundos; o "Asaas" dispara o webhook.
+    time.sleep(rng.uniform(0, args.atraso_pagamento))
+    pago_em = time.time()
+    inicio = time.perf_counter()
+    try:
+        status = fakes.enviar_webhook_pago(cliente.base_url, checkout_id, WEBHOOK_TOKEN)
+    except (urllib.error.URLError, TimeoutError, ConnectionError):
+        status = 0
+    cliente.coletor.registrar("POST /webhook/asaas", time.perf_counter() - inicio, ok=status == 200)
+
+    limite = time.monotonic() + args.timeout_email
+    while time.monotonic() < limite:
+        status, pedido = cliente.chamar("GET /order/{id}", "GET", f"/order/{order_id}")
+        if status == 200 and pedido.get("status") == "processado":
+            break
+        time.sleep(args.intervalo_poll)
+
+    entregue = sink.entregue_em(order_id)
+    if entregue is not None:
+        cliente.coletor.registrar(E2E, max(0.0, entregue - pago_em))
+    else:
+        cliente.coletor.registrar(E2E, args.timeout_email, ok=False)
+
+
+def _subir_api(porta: int, env: dict, log_path: Path) -> subprocess.Popen:
+    log = open(log_path, "w", encoding="utf-8")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(porta),
+         "--log-level", "warning"],
+        cwd=API_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        if proc.poll() is not None:
+            raise RuntimeError(f"API encerrou ao subir (veja {log_path})")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{porta}/health", timeout=1):
+                return proc
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"API não respondeu /health em 30s (veja {log_path})")
+
+
+def _imprimir(resultado: dict) -> None:
+    print(f"\nPedidos: {resultado['config']['pedidos']}  usuários: {resultado['config']['usuarios']}  "
+          f"duração: {resultado['duracao_s']:.1f}s  chamadas Gemini: {resultado['gemini_chamadas']}")
+    print(f"{'endpoint':<24}{'n':>6}{'erros':>7}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, s in resultado["endpoints"].items():
+        print(f"{endpoint:<24}{s['n']:>6}{s['erros']:>7}{s['rps']:>9.2f}"
+              f"{s['p50'] * 1000:>10.1f}{s['p95'] * 1000:>10.1f}{s['p99'] * 1000:>10.1f}")
+
+
+def _comparar(resultado: dict, baseline: dict, tolerancia: float) -> list[str]:
+    """Lista regressões: p95 acima do baseline*(1+tolerância) ou taxa de erro maior."""
+    regressoes = []
+    for endpoint, base in baseline.get("endpoints", {}).items():
+        atual = resultado["endpoints"].get(endpoint)
+        if atual is None:
+            regressoes.append(f"{endpoint}: ausente nesta execução")
+            continue
+        if base["p95"] > 0 and atual["p95"] > base["p95"] * (1 + tolerancia):
+            regressoes.append(
+                f"{endpoint}: p95 {atual['p95'] * 1000:.1f} ms > baseline {base['p95'] * 1000:.1f} ms"
+            )
+        taxa_base = base["erros"] / base["n"] if base["n"] else 0
+        taxa_atual = atual["erros"] / atual["n"] if atual["n"] else 0
+        if taxa_atual > taxa_base + 0.01:
+            regressoes.append(f"{endpoint}: taxa de erro {taxa_atual:.1%} > baseline {taxa_base:.1%}")
+    return regressoes
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pedidos", type=int, default=20, help="jornadas de compra no total")
+    parser.add_argument("--usuarios", type=int, default=5, help="clientes simultâneos")
+    parser.add_argument("--fotos-max", type=int, default=3, help="fotos por pedido (1..N)")
+    parser.add_argument("--foto-px", type=int, default=512, help="lado das fotos enviadas, em px")
+    parser.add_argument("--atraso-pagamento", type=float, default=1.0, help="atraso máx. até o webhook (s)")
+    parser.add_argument("--intervalo-poll", type=float, default=1.0, help="intervalo de GET /order (s)")
+    parser.add_argument("--timeout-email", type=float, default=300.0, help="espera máx. pelo email (s)")
+    parser.add_argument("--gemini-latencia", type=float, default=2.0)
+    parser.add_argument("--gemini-erro", type=float, default=0.0, help="fração de respostas 429")
+    parser.add_argument("--asaas-latencia", type=float, default=0.2)
+    parser.add_argument("--smtp-latencia", type=float, default=0.05)
+    parser.add_argument("--rate-limit-pet", type=float, default=0.0,
+                        help="RATE_LIMIT_PET_PER_MIN da API (default 0 = sem limite; todo tráfego vem de 127.0.0.1)")
+    parser.add_argument("--rate-limit-telemetria", type=float, default=0.0,
+                        help="RATE_LIMIT_TELEMETRY_PER_MIN da API (default 0 = sem limite)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--salvar-baseline", metavar="NOME")
+    parser.add_argument("--comparar", metavar="NOME", help="compara com loadtest_baselines/NOME.json")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="folga sobre o p95 do baseline")
+    args = parser.parse_args(argv)
+
+    asaas = fakes.FakeAsaas(args.asaas_latencia).start()
+    gemini = fakes.FakeGemini(args.gemini_latencia, args.gemini_latencia / 4, args.gemini_erro).start()
+    sink = fakes.SmtpSink(args.smtp_latencia).start()
+    porta = _porta_livre()
+
+    with tempfile.TemporaryDirectory(prefix="petstory-loadtest-") as tmp:
+        env = {
+            **os.environ,
+            "PETSTORY_DATA_DIR": str(Path(tmp) / "data"),
+            "PETSTORY_UPLOADS_DIR": str(Path(tmp) / "uploads"),
+            "TELEMETRY_DB": str(Path(tmp) / "telemetry.db"),
+            "ASAAS_BASE_URL": asaas.url,
+            "ASAAS_API_KEY": "loadtest",
+            "ASAAS_WEBHOOK_TOKEN": WEBHOOK_TOKEN,
+            "FRONTEND_BASE_URL": "https://loadtest.petstory.invalid",
+            "GEMINI_BASE_URL": gemini.url,
+            "GEMINI_API_KEY": "loadtest",
+            "GEMINI_MODEL": "loadtest-image",
+            "SMTP_SERVER": sink.host,
+            "SMTP_PORT": str(sink.port),
+            "SMTP_USER": "loadtest",
+            "SMTP_PASSWORD": "loadtest",
+            "SMTP_STARTTLS": "false",
+            "EMAIL_FROM": "loadtest@petstory.invalid",
+            "EMAIL_TO": "",
+            "RATE_LIMIT_PET_PER_MIN": str(args.rate_limit_pet),
+            "RATE_LIMIT_TELEMETRY_PER_MIN": str(args.rate_limit_telemetria),
+        }
+        proc = _subir_api(porta, env, Path(tmp) / "api.log")
+        coletor = Coletor()
+        cliente = Cliente(f"http://127.0.0.1:{porta}", coletor)
+        inicio = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=args.usuarios) as pool:
+                list(pool.map(lambda n: _jornada(n, cliente, asaas, sink, args), range(args.pedidos)))
+        finally:
+            duracao = time.perf_counter() - inicio
+            proc.terminate()
+            proc.wait(timeout=10)
+            asaas.stop()
+            gemini.stop()
+            sink.stop()
+
+    resultado = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("salvar_baseline", "comparar")},
+        "duracao_s": round(duracao, 3),
+        "gemini_chamadas": gemini.chamadas,
+        "endpoints": coletor.resumo(duracao),
+    }
+    _imprimir(resultado)
+
+    codigo = 0
+    if args.comparar:
+        baseline = json.loads((BASELINES_DIR / f"{args.comparar}.json").read_text(encoding="utf-8"))
+        regressoes = _comparar(resultado, baseline, args.tolerancia)
+        for r in regressoes:
+            print(f"REGRESSÃO {r}")
+        if regressoes:
+            codigo = 1
+        else:
+            print(f"Sem regressões em relação a {args.comparar} (tolerância {args.tolerancia:.0%}).")
+    if args.salvar_baseline:
+        BASELINES_DIR.mkdir(parents=True, exist_ok=True)
+        path = BASELINES_DIR / f"{args.salvar_baseline}.json"
+        path.write_text(json.dumps(resultado, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"Baseline salvo em {path}")
+    return codigo
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,8 @@ from email.message import EmailMessage
 
 from dotenv import load_dotenv
 
+import profiling
+
 load_dotenv()
 
 EMAIL_LOG = Path(__file__).resolve().parent / "logs" / "email.log"
@@ -67,8 +69,9 @@ def enviar_email(pedido: dict, pdf_bytes: bytes | None = None) -> None:
     if pdf_bytes:
         msg.add_attachment(pdf_bytes, maintype="application", subtype="pdf", filename="livro_pet.pdf")
 
-    with smtplib.SMTP(server, port) as smtp:
-        smtp.starttls()
+    with profiling.span("smtp_send"), smtplib.SMTP(server, port) as smtp:
+        if os.getenv("SMTP_STARTTLS", "true").strip().lower() in ("true", "1"):
+            smtp.starttls()
         smtp.login(user, password)
         smtp.send_message(msg)
     log_email(f"Pedido {order_id} - enviado com sucesso")
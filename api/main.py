@@ -3,16 +3,24 @@ import os
 import uvicorn
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi import Form, File, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 
 load_dotenv()
 
 import store
+import admission
+import archive
 import asaas
+import backup
+import metrics
+import phash
+import profiling
 import telemetry
-from process import processar_pedido
+from process import LIVRO_PDF_NAME, aguardando_lote, processar_pedido
 
 MAX_FILES = 5
 MAX_FILE_BYTES = 10 * 1024 * 1024  # 10 MB
@@ -33,10 +41,45 @@ async def lifespan(app: FastAPI):
     telemetry.init_db()
     print("Telemetry database initialized", flush=True)
 
+    fila.start()
     yield
+    fila.stop()
 
 
 app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def profiling_middleware(request: Request, call_next):
+    """Perfila a requisição quando PROFILE_REQUESTS está ativo ou o header de profiling é válido."""
+    if not profiling.request_profiling_enabled(request.headers.get(profiling.PROFILE_HEADER)):
+        return await call_next(request)
+    with profiling.request_profile(request.method, request.url.path):
+        return await call_next(request)
+
+
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    """Limite de taxa por IP e de uploads simultâneos, antes de o corpo (multipart) ser lido."""
+    cliente = admission.client_ip(request.headers, request.client.host if request.client else None)
+    try:
+        with admission.admitir_requisicao(
+            request.method,
+            request.url.path,
+            cliente,
+            request.headers.get("content-length"),
+            max_body=MAX_FILES * MAX_FILE_BYTES + 1024 * 1024,  # folga para campos e boundaries
+        ):
+            return await call_next(request)
+    except admission.Rejeitado as e:
+        return JSONResponse(
+            status_code=e.status,
+            content={"detail": e.motivo},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+# Adicionado por último = camada mais externa: respostas 429 também levam headers CORS.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -68,6 +111,7 @@ async def create_pet(
     if len(pet_file) > MAX_FILES:
         raise HTTPException(status_code=400, detail="Máximo 5 imagens.")
     file_names: list[str] = []
+    phashes: dict[str, str | None] = {}
     order_id = store.create_order(
         pet_name=pet_name, user_email=user_email, file_names=[]
     )
@@ -75,16 +119,19 @@ async def create_pet(
     order_dir.mkdir(parents=True, exist_ok=True)
     for f in pet_file:
         if f.filename:
-            content = await f.read()
+            # Lê no máximo MAX_FILE_BYTES + 1: basta para detectar excesso sem carregar o resto.
+            content = await f.read(MAX_FILE_BYTES + 1)
             if len(content) > MAX_FILE_BYTES:
                 raise HTTPException(
                     status_code=400,
                     detail=f"Cada arquivo deve ter no máximo 10 MB. ({f.filename})",
                 )
             path = order_dir / f.filename
-            path.write_bytes(content)
+            with metrics.etapa("upload"):
+                path.write_bytes(content)
             file_names.append(f.filename)
-    store.update_order_file_names(order_id, file_names)
+            phashes[f.filename] = await run_in_threadpool(phash.dhash, content)
+    store.update_order_file_names(order_id, file_names, phashes)
 
     # Asaas exige successUrl/cancelUrl em domínio cadastrado na conta; localhost é rejeitado.
     # Use FRONTEND_BASE_URL com URL pública HTTPS (ex.: ngrok) e cadastre o domínio no Asaas.
@@ -111,14 +158,15 @@ async def create_pet(
     success_url = f"{base}/?checkout=success"
     cancel_url = f"{base}/?checkout=cancel"
     try:
-        result = asaas.criar_checkout(
-            order_id=order_id,
-            valor=_checkout_value(),
-            nome_cliente=pet_name,
-            email_cliente=user_email,
-            success_url=success_url,
-            cancel_url=cancel_url,
-        )
+        with metrics.etapa("checkout"):
+            result = asaas.criar_checkout(
+                order_id=order_id,
+                valor=_checkout_value(),
+                nome_cliente=pet_name,
+                email_cliente=user_email,
+                success_url=success_url,
+                cancel_url=cancel_url,
+            )
     except ValueError as e:
         logger.warning("Falha ao criar checkout Asaas: %s", e)
         raise HTTPException(
@@ -129,9 +177,29 @@ async def create_pet(
     return {"ok": True, "checkout_url": result["checkout_url"]}
 
 
+def _processar_em_background(pedido: dict, trace: bool = False) -> bool:
+    """Executado pelos workers da fila: processa o pedido (com trace se o webhook foi perfilado)."""
+    with profiling.order_trace(pedido["order_id"], forcar=trace):
+        return processar_pedido(pedido)
+
+
+def _pendentes_para_fila() -> list[dict]:
+    """Pedidos pagos e pendentes que ninguém está processando (process.py, batch.py) nem aguardam lote."""
+    return [
+        p for p in store.list_pending_production()
+        if not store.claim_ativo(p) and not aguardando_lote(p)
+    ]
+
+
+fila = admission.FilaProcessamento(_processar_em_background, pendentes=_pendentes_para_fila)
+
+
 @app.post("/webhook/asaas")
-async def webhook_asaas(request: Request, background_tasks: BackgroundTasks):
-    """Recebe eventos do Asaas (ex.: CHECKOUT_PAID). Valida token; marca como pago e enfileira processamento em background."""
+async def webhook_asaas(request: Request):
+    """
+    Recebe eventos do Asaas (ex.: CHECKOUT_PAID). Valida token; marca como pago e enfileira processamento.
+    Sempre 200 para eventos válidos: respostas não-2xx repetidas fazem o Asaas pausar a fila de webhooks.
+    """
     token_recebido = request.headers.get("asaas-access-token")
     token_esperado = os.getenv("ASAAS_WEBHOOK_TOKEN", "").strip()
     if not asaas.webhook_token_valido(token_recebido, token_esperado):
@@ -145,7 +213,11 @@ async def webhook_asaas(request: Request, background_tasks: BackgroundTasks):
         order = store.get_order(order_id)
         if order:
             pedido = {**order, "order_id": order_id}
-            background_tasks.add_task(processar_pedido, pedido)
+            try:
+                fila.enfileirar(pedido, trace=profiling.ativo())
+            except admission.Rejeitado:
+                # Fila cheia: o pedido segue pago e pendente no store; a varredura da fila (ou process.py) o retoma.
+                logger.warning("Pedido %s pago com a fila cheia; fica para a próxima varredura", order_id)
     return {"received": True}
 
 
@@ -158,10 +230,23 @@ async def get_order(order_id: str):
     return order
 
 
+@app.get("/order/{order_id}/livro")
+async def get_order_livro(order_id: str):
+    """Baixa o livro (PDF) do pedido; pedidos arquivados têm o PDF extraído sob demanda."""
+    if not store.get_order(order_id):
+        raise HTTPException(status_code=404, detail="Pedido não encontrado")
+    path = archive.arquivo_do_pedido(order_id, LIVRO_PDF_NAME)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Livro não encontrado")
+    return FileResponse(path, media_type="application/pdf", filename="livro_pet.pdf")
+
+
 @app.post("/telemetry/event")
-async def receive_telemetry_event(event: telemetry.TelemetryEvent):
-    """Recebe eventos de telemetria do frontend."""
-    telemetry.save_event(event)
+async def receive_telemetry_event(event: telemetry.TelemetryEvent, request: Request):
+    """Recebe eventos de telemetria do frontend; bots, duplicados e eventos fora da amostra não são gravados."""
+    sample_rate = telemetry.filter_event(event, request.headers.get("user-agent"))
+    if sample_rate is not None:
+        telemetry.save_event(event, sample_rate)
     return {"ok": True}
 
 
@@ -174,6 +259,24 @@ async def get_telemetry_summary():
     }
 
 
+@app.post("/admin/backup")
+async def post_backup(request: Request, com_uploads: bool = False):
+    """Cria um snapshot online (pedidos, camada fria e telemetria) sem parar a API."""
+    if not backup.autorizado(request.headers.get(backup.BACKUP_HEADER)):
+        raise HTTPException(status_code=403, detail="Não autorizado")
+    try:
+        manifesto = await run_in_threadpool(backup.criar_snapshot, com_uploads)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {k: v for k, v in manifesto.items() if k != "arquivos"} | {"arquivos": len(manifesto["arquivos"])}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> str:
+    """Exporta métricas no formato texto do Prometheus."""
+    return metrics.render()
+
+
 if __name__ == "__main__":
     host = os.getenv("API_HOST", "0.0.0.0")
     port = int(os.getenv("API_PORT", "8000"))
@@ -0,0 +1,242 @@
+"""
+Métricas em memória expostas no formato texto do Prometheus (GET /metrics).
+Sem dependências externas: histogramas, contadores e gauges com um lock cada,
+custo no caminho quente = um bisect + uma soma.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+import profiling
+
+# Buckets em segundos: cobre de escrita em disco (ms) até geração Gemini (dezenas de s).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_REGISTRY: list = []
+
+
+def _fmt_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pares = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def _fmt_num(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], object] = {}
+        _REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _render_values(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        linhas = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            linhas.extend(self._render_values())
+        return linhas
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_values(self) -> list[str]:
+        return [
+            f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_num(v)}"
+            for k, v in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def _render_values(self) -> list[str]:
+        if not self._values and not self.labelnames:
+            return [f"{self.name} 0"]
+        return [
+            f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_num(v)}"
+            for k, v in sorted(self._values.items())
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...] = (), buckets=BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            serie = self._values.get(key)
+            if serie is None:
+                # [contagem por bucket (+Inf no fim), soma, total]
+                serie = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = serie
+            serie[0][idx] += 1
+            serie[1] += value
+            serie[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Mede a duração do bloco; observa mesmo se o bloco levantar exceção."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - inicio, **labels)
+
+    def _render_values(self) -> list[str]:
+        linhas: list[str] = []
+        for key, (contagens, soma, total) in sorted(self._values.items()):
+            acumulado = 0
+            for limite, n in zip(self.buckets, contagens):
+                acumulado += n
+                le = _fmt_labels(self.labelnames, key, f'le="{_fmt_num(limite)}"')
+                linhas.append(f"{self.name}_bucket{le} {acumulado}")
+            le = _fmt_labels(self.labelnames, key, 'le="+Inf"')
+            linhas.append(f"{self.name}_bucket{le} {total}")
+            base = _fmt_labels(self.labelnames, key)
+            linhas.append(f"{self.name}_sum{base} {soma!r}")
+            linhas.append(f"{self.name}_count{base} {total}")
+        return linhas
+
+
+def cronometrar(hist: Histogram, **labels):
+    """Decorator: observa em hist a duração de cada chamada da função."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with hist.time(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def etapa(stage: str):
+    """Mede uma etapa do pipeline (STAGE_SECONDS), conta falhas em STAGE_ERRORS e abre um span de trace."""
+    try:
+        with STAGE_SECONDS.time(stage=stage), profiling.span(stage):
+            yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+
+
+def render() -> str:
+    """Retorna todas as métricas registradas no formato de exposição texto do Prometheus."""
+    linhas: list[str] = []
+    for metric in _REGISTRY:
+        linhas.extend(metric.render())
+    return "\n".join(linhas) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "petstory_stage_duration_seconds",
+    "Duração das etapas do pedido (upload, checkout, pagina, pdf, email).",
+    ("stage",),
+)
+STAGE_ERRORS = Counter(
+    "petstory_stage_errors_total",
+    "Falhas por etapa do pedido.",
+    ("stage",),
+)
+GEMINI_SECONDS = Histogram(
+    "petstory_gemini_duration_seconds",
+    "Duração de cada chamada gerar_imagem, por tema (fiel, superhero, astronaut...).",
+    ("tema",),
+)
+GEMINI_ERRORS = Counter(
+    "petstory_gemini_errors_total",
+    "Falhas em gerar_imagem, por tema.",
+    ("tema",),
+)
+STORE_SECONDS = Histogram(
+    "petstory_store_duration_seconds",
+    "Duração das operações do store de pedidos.",
+    ("op",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+ORDERS_PROCESSED = Counter(
+    "petstory_orders_processed_total",
+    "Pedidos que passaram por processar_pedido, por resultado (ok, falha).",
+    ("resultado",),
+)
+QUEUE_DEPTH = Gauge(
+    "petstory_processing_queue_depth",
+    "Pedidos pagos enfileirados para processamento e ainda não iniciados.",
+)
+ORDERS_IN_FLIGHT = Gauge(
+    "petstory_orders_in_flight",
+    "Pedidos em processamento neste momento.",
+)
+GENERATIONS_IN_FLIGHT = Gauge(
+    "petstory_gemini_generations_in_flight",
+    "Chamadas gerar_imagem em andamento.",
+)
+QUEUE_CAPACITY = Gauge(
+    "petstory_processing_queue_capacity",
+    "Capacidade atual (adaptativa) da fila de processamento.",
+)
+UPLOADS_IN_FLIGHT = Gauge(
+    "petstory_uploads_in_flight",
+    "Requisições POST /pet em andamento.",
+)
+UPLOAD_BYTES_IN_FLIGHT = Gauge(
+    "petstory_upload_bytes_in_flight",
+    "Soma dos Content-Length dos uploads em andamento.",
+)
+ADMISSION_REJECTED = Counter(
+    "petstory_admission_rejected_total",
+    "Requisições recusadas pelo controle de admissão, por motivo (taxa, uploads, tamanho, fila).",
+    ("motivo",),
+)
+GEMINI_BATCH_JOBS = Counter(
+    "petstory_gemini_batch_jobs_total",
+    "Gerações em modo lote, por resultado (submetido, ok, falha).",
+    ("resultado",),
+)
+GENERATIONS_AVOIDED = Counter(
+    "petstory_gemini_generations_avoided_total",
+    "Gerações poupadas por fotos quase iguais no mesmo pedido (phash).",
+)
+TELEMETRY_EVENTS = Counter(
+    "petstory_telemetry_events_total",
+    "Beacons recebidos em /telemetry/event, por resultado do filtro (gravado, bot, duplicado, fora_da_amostra).",
+    ("resultado",),
+)
@@ -1,15 +1,62 @@
 """
 Gera PDF do pedido: capa (nome do pet), blocos por foto (line art fiel + 2 cenas aventura), contracapa.
 Usa fontes da pasta api/fonts (qualquer .ttf) nas escritas do livro.
+
+Páginas são preparadas assim que cada imagem é gerada (preparar_pagina: no máximo PAGINA_DPI na
+área útil, PNG sem perdas, em cinza quando a imagem não tem cor); assim gerar_pdf_pedido só junta
+páginas prontas com capa e contracapa. PNG e não JPEG: o livro é impresso e JPEG cria halos em
+volta das linhas pretas do line art; 300 dpi é a resolução usual de impressão.
 """
+import os
+import uuid
 from pathlib import Path
 
 from fpdf import FPDF
+from PIL import Image, ImageChops
+
+import profiling
 
 FONTS_DIR = Path(__file__).resolve().parent / "fonts"
 FONT_FAMILY_LIVRO = "Livro"
 SUFIXOS = ("_fiel", "_aventura_1", "_aventura_2")
 
+# Área útil da página A4 com margens padrão do fpdf (10 mm): 190 x 277 mm.
+PAGINA_DPI = 300
+PAGINA_MAX_PX = (round(190 / 25.4 * PAGINA_DPI), round(277 / 25.4 * PAGINA_DPI))
+
+
+def pagina_preparada(imagem: Path) -> Path:
+    """Caminho da página pronta correspondente a gerado_*.png."""
+    return imagem.with_name(f"pagina_{imagem.stem}.png")
+
+
+def preparar_pagina(imagem: Path) -> Path:
+    """
+    Converte a imagem gerada em página pronta para o PDF: reduzida só se passar de PAGINA_MAX_PX
+    (nunca ampliada), PNG sem perdas, em cinza se não tiver cor. Grava via .tmp + rename e retorna
+    o caminho da página.
+    """
+    destino = pagina_preparada(imagem)
+    with profiling.span("preparar_pagina", arquivo=imagem.name):
+        with Image.open(imagem) as img:
+            pagina = img.convert("RGB")
+        r, g, b = pagina.split()
+        if ImageChops.difference(r, g).getbbox() is None and ImageChops.difference(g, b).getbbox() is None:
+            pagina = r  # sem cor: 1 canal, um terço do tamanho
+        pagina.thumbnail(PAGINA_MAX_PX, Image.Resampling.LANCZOS)
+        tmp = destino.with_name(f"{destino.name}.{uuid.uuid4().hex}.tmp")
+        pagina.save(tmp, format="PNG", optimize=True)
+        os.replace(tmp, destino)
+    return destino
+
+
+def _pagina(imagem: Path) -> Path:
+    """Página pronta da imagem; prepara agora se faltar ou estiver desatualizada (pedidos antigos)."""
+    pagina = pagina_preparada(imagem)
+    if pagina.exists() and pagina.stat().st_mtime >= imagem.stat().st_mtime:
+        return pagina
+    return preparar_pagina(imagem)
+
 
 def _setup_font(pdf: FPDF) -> bool:
     """Registra fonte da pasta api/fonts se existir algum .ttf. Retorna True se registrou."""
@@ -36,12 +83,20 @@ def _imagens_ordenadas(pasta: Path, file_names: list[str]) -> list[Path]:
     return paths
 
 
-def gerar_pdf_pedido(pasta: Path, pet_name: str, file_names: list[str]) -> bytes:
+def gerar_pdf_pedido(
+    pasta: Path, pet_name: str, file_names: list[str], imagens: list[Path] | None = None
+) -> bytes:
     """
     Gera PDF com capa, para cada foto (fiel, aventura_1, aventura_2) e contracapa.
-    file_names define a ordem das fotos. Levanta ValueError se alguma imagem esperada não existir.
+    file_names define a ordem das fotos; imagens, se dado, é a lista exata de páginas (ex.: plano com
+    quase-duplicatas). Levanta ValueError se alguma imagem esperada não existir.
     """
-    imagens = _imagens_ordenadas(pasta, file_names)
+    if imagens is None:
+        imagens = _imagens_ordenadas(pasta, file_names)
+    else:
+        for path in imagens:
+            if not path.exists():
+                raise ValueError(f"Imagem esperada não encontrada: {path.name}")
     if not imagens:
         raise ValueError("Nenhuma imagem gerada para o pedido")
 
@@ -59,10 +114,12 @@ def gerar_pdf_pedido(pasta: Path, pet_name: str, file_names: list[str]) -> bytes
     pdf.set_font(font_name, "", size=14)
     pdf.cell(0, 10, "Livro de colorir", align="C", new_x="LMARGIN", new_y="NEXT")
 
-    # Blocos por foto: fiel, aventura_1, aventura_2
+    # Blocos por foto: fiel, aventura_1, aventura_2 (páginas já preparadas)
     for path in imagens:
         pdf.add_page()
-        pdf.image(str(path), x=15, y=20, w=pdf.epw, h=pdf.eph, keep_aspect_ratio=True)
+        pagina = _pagina(path)
+        with profiling.span("pdf_image", arquivo=pagina.name):
+            pdf.image(str(pagina), x=15, y=20, w=pdf.epw, h=pdf.eph, keep_aspect_ratio=True)
 
     # Contracapa
     pdf.add_page()
@@ -70,4 +127,5 @@ def gerar_pdf_pedido(pasta: Path, pet_name: str, file_names: list[str]) -> bytes
     pdf.ln(100)
     pdf.multi_cell(0, 12, "Gerado com muito amor pela\npetstory.live", align="C")
 
-    return bytes(pdf.output())
+    with profiling.span("pdf_output"):
+        return bytes(pdf.output())
@@ -0,0 +1,65 @@
+"""
+Hash perceptual (dHash de 64 bits) das fotos enviadas, para detectar quase-duplicatas
+(ex.: fotos em rajada) num mesmo pedido. Calculado no upload (POST /pet) e guardado no pedido.
+PHASH_THRESHOLD: distância de Hamming máxima para considerar duas fotos iguais (default 10;
+negativo desativa a detecção).
+"""
+import io
+import os
+
+from PIL import Image, UnidentifiedImageError
+
+LIMIAR_PADRAO = 10
+
+
+def limiar() -> int:
+    try:
+        return int(os.getenv("PHASH_THRESHOLD", "").strip() or LIMIAR_PADRAO)
+    except ValueError:
+        return LIMIAR_PADRAO
+
+
+def dhash(image_bytes: bytes) -> str | None:
+    """dHash em hex (16 caracteres): compara vizinhos horizontais numa miniatura 9x8 em cinza. None se não for imagem."""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.draft("L", (64, 64))  # JPEG: decodifica já reduzido
+            mini = img.convert("L").resize((9, 8), Image.Resampling.BOX)
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+    px = list(mini.getdata())
+    bits = 0
+    for y in range(8):
+        linha = px[y * 9:(y + 1) * 9]
+        for x in range(8):
+            bits = (bits << 1) | (linha[x] > linha[x + 1])
+    return f"{bits:016x}"
+
+
+def distancia(a: str, b: str) -> int:
+    """Distância de Hamming entre dois hashes hex."""
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def agrupar(file_names: list[str], hashes: dict[str, str | None], limite: int | None = None) -> list[list[str]]:
+    """
+    Agrupa fotos quase iguais, na ordem de file_names. Cada grupo começa pela primeira foto
+    (representante); as seguintes entram no primeiro grupo cujo representante está a até `limite`.
+    Fotos sem hash ficam sozinhas.
+    """
+    limite = limiar() if limite is None else limite
+    grupos: list[list[str]] = []
+    for nome in file_names:
+        h = hashes.get(nome)
+        destino = None
+        if h and limite >= 0:
+            for grupo in grupos:
+                rep = hashes.get(grupo[0])
+                if rep and distancia(h, rep) <= limite:
+                    destino = grupo
+                    break
+        if destino is None:
+            grupos.append([nome])
+        else:
+            destino.append(nome)
+    return grupos
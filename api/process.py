@@ -2,84 +2,447 @@
 Processa pedidos com pagamento ok e status pendente.
 Gera imagens (Gemini): 1 line art fiel + 2 cenas de aventura por foto; monta PDF, envia email e marca como processado.
 Rode com: uv run process.py (na pasta api) ou python -m api.process
+
+Para drenar backlog: uv run process.py --pedidos-paralelos 4 --geracoes-paralelas 3 --max-gasto 50
+(--help lista filtros por data/pedido, --dry-run e demais opções). Cada etapa é checkpoint:
+imagens já gravadas, livro.pdf e status processado não são refeitos, então um dreno interrompido
+retoma de onde parou. Pode rodar junto da API ou de outro dreno: processar_pedido reivindica o pedido
+no store (store.claim_order, lease de PROCESS_LEASE_SECONDS) antes de gerar e o renova antes do email;
+quem não consegue a reivindicação pula o pedido. Para backlog sem pressa, batch.py gera as imagens via batch jobs do Gemini.
 """
+import argparse
+import contextvars
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
 
+import metrics
+import phash
+import profiling
 import store
-from gemini import PROMPT_LINE_ART, TEMAS_AVENTURA_V1, gerar_imagem, prompt_aventura
+from gemini import (
+    PROMPT_LINE_ART,
+    TEMAS_AVENTURA_EXTRAS,
+    TEMAS_AVENTURA_V1,
+    gerar_imagem,
+    prompt_aventura,
+)
 from mail import enviar_email, log_email
-from pdf import gerar_pdf_pedido
+from pdf import gerar_pdf_pedido, preparar_pagina
 
 EXTENSOES_IMAGEM = (".jpg", ".jpeg", ".png", ".webp")
 LIVRO_PDF_NAME = "livro.pdf"
+# Manifestos dos lotes abertos (batch.py): gerações ali já foram pagas e chegam na coleta.
+BATCHES_DIR = store.BATCHES_DIR
+
+
+class Geracao(NamedTuple):
+    """Uma chamada gerar_imagem pendente: foto de origem, arquivo de saída, prompt e tema (métricas)."""
+    foto: Path
+    destino: Path
+    prompt: str
+    tema: str
+
+
+def gravar_atomico(path: Path, data: bytes) -> None:
+    """Grava via arquivo temporário (nome único) + rename: um arquivo final nunca fica pela metade."""
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _gerar(image_bytes: bytes, prompt: str, tema: str) -> bytes:
+    """Chama gerar_imagem registrando duração, falhas e gerações em andamento por tema."""
+    metrics.GENERATIONS_IN_FLIGHT.inc()
+    try:
+        with metrics.GEMINI_SECONDS.time(tema=tema), profiling.span("gerar_imagem", tema=tema):
+            return gerar_imagem(image_bytes, prompt)
+    except Exception:
+        metrics.GEMINI_ERRORS.inc(tema=tema)
+        raise
+    finally:
+        metrics.GENERATIONS_IN_FLIGHT.dec()
+
+
+def fotos_validas(pedido: dict) -> list[str]:
+    """Fotos do pedido que existem na pasta e têm extensão de imagem, na ordem enviada."""
+    pasta = store.UPLOADS_DIR / pedido["order_id"]
+    return [
+        f for f in pedido.get("file_names") or []
+        if (pasta / f).exists() and Path(f).suffix.lower() in EXTENSOES_IMAGEM
+    ]
+
+
+def _hashes(pedido: dict, fotos: list[str]) -> dict[str, str | None]:
+    """
+    Hashes perceptuais salvos no upload. Os que faltarem (pedidos antigos) são calculados uma vez e
+    gravados no pedido (e no dict recebido), para as próximas chamadas não decodificarem as fotos de novo.
+    """
+    pasta = store.UPLOADS_DIR / pedido["order_id"]
+    salvos = pedido.get("phashes") or {}
+    faltando = {f: phash.dhash((pasta / f).read_bytes()) for f in fotos if f not in salvos}
+    if faltando:
+        salvos = {**salvos, **faltando}
+        pedido["phashes"] = salvos
+        store.update_order_file_names(pedido["order_id"], pedido.get("file_names") or [], salvos)
+    return {f: salvos[f] for f in fotos}
+
+
+def plano_paginas(pedido: dict) -> list[Geracao]:
+    """
+    Todas as imagens do livro, na ordem das páginas. Cada foto rende 1 line art fiel + 2 aventuras
+    (temas v1). Fotos quase iguais a uma anterior (phash) não repetem o fiel nem as cenas v1:
+    recebem 2 temas ainda não usados do catálogo extra, ou nenhuma página se o catálogo acabar.
+    """
+    pasta = store.UPLOADS_DIR / pedido["order_id"]
+    pet_name = pedido.get("pet_name", "")
+    fotos = fotos_validas(pedido)
+    duplicatas: set[str] = set()
+    for grupo in phash.agrupar(fotos, _hashes(pedido, fotos)):
+        duplicatas.update(grupo[1:])
+    extras = iter(TEMAS_AVENTURA_EXTRAS)
+
+    paginas: list[Geracao] = []
+    for filename in fotos:
+        foto = pasta / filename
+        stem = foto.stem
+        if filename in duplicatas:
+            temas = [t for t in (next(extras, None) for _ in TEMAS_AVENTURA_V1) if t is not None]
+        else:
+            # 1) Line art fiel
+            paginas.append(Geracao(foto, pasta / f"gerado_{stem}_fiel.png", PROMPT_LINE_ART, "fiel"))
+            temas = TEMAS_AVENTURA_V1
+
+        # 2) Cenas de aventura (v1: superhero, astronaut; duplicatas: temas extras)
+        for i, (tema_id, _) in enumerate(temas, start=1):
+            out_aventura = pasta / f"gerado_{stem}_aventura_{i}.png"
+            paginas.append(Geracao(foto, out_aventura, prompt_aventura(tema_id, pet_name), tema_id))
+    return paginas
+
+
+def geracoes_evitadas(pedido: dict, plano: list[Geracao]) -> int:
+    """Gerações poupadas pela detecção de quase-duplicatas (3 por foto menos as planejadas)."""
+    return (1 + len(TEMAS_AVENTURA_V1)) * len(fotos_validas(pedido)) - len(plano)
+
+
+def manifestos_lote() -> list[tuple[Path, dict]]:
+    """(caminho, manifesto) dos lotes abertos em BATCHES_DIR."""
+    if not BATCHES_DIR.is_dir():
+        return []
+    return [
+        (path, json.loads(path.read_text(encoding="utf-8")))
+        for path in sorted(BATCHES_DIR.glob("*.json"))
+    ]
+
+
+def destinos_em_lote() -> set[str]:
+    """Arquivos de saída de gerações que estão em lotes abertos."""
+    return {job["destino"] for _, m in manifestos_lote() for job in m["jobs"]}
+
+
+def geracoes_pendentes(pedido: dict, incluir_em_lote: bool = False) -> list[Geracao]:
+    """Gerações do plano que ainda não têm arquivo gerado (sem as que aguardam lote aberto, salvo incluir_em_lote)."""
+    faltando = [g for g in plano_paginas(pedido) if not g.destino.exists()]
+    if incluir_em_lote or not faltando:
+        return faltando
+    em_lote = destinos_em_lote()
+    return [g for g in faltando if str(g.destino) not in em_lote]
+
+
+def aguardando_lote(pedido: dict) -> bool:
+    """True se alguma imagem do pedido está num lote aberto: gerar agora pagaria a imagem duas vezes."""
+    faltando = {str(g.destino) for g in plano_paginas(pedido) if not g.destino.exists()}
+    return bool(faltando) and not faltando.isdisjoint(destinos_em_lote())
+
+
+def concluir_geracao(destino: Path, png: bytes) -> None:
+    """Grava a imagem gerada e já prepara sua página do PDF, espalhando o custo de CPU entre as gerações."""
+    gravar_atomico(destino, png)
+    with metrics.etapa("pagina"):
+        preparar_pagina(destino)
+
+
+def _executar_geracao(geracao: Geracao) -> None:
+    concluir_geracao(geracao.destino, _gerar(geracao.foto.read_bytes(), geracao.prompt, geracao.tema))
 
 
-def processar_pedido(pedido: dict) -> None:
+def _gerar_pendentes(geracoes: list[Geracao], max_geracoes: int) -> None:
     """
-    Processa um pedido: gera imagens via Gemini (1 fiel + 2 aventuras por foto, só as que faltam),
+    Executa as gerações, até max_geracoes em paralelo. Cada imagem é gravada (e sua página do PDF
+    preparada) assim que fica pronta; se alguma falhar, as demais terminam (ficam como checkpoint)
+    e a primeira falha é relançada.
+    """
+    if max_geracoes <= 1 or len(geracoes) <= 1:
+        for geracao in geracoes:
+            _executar_geracao(geracao)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_geracoes, len(geracoes))) as pool:
+        # copy_context: spans do trace do pedido continuam valendo nas threads.
+        futures = [
+            pool.submit(contextvars.copy_context().run, _executar_geracao, g) for g in geracoes
+        ]
+    for future in futures:
+        future.result()
+
+
+def novo_dono() -> str:
+    """Identificador de quem reivindica pedidos (host, pid e um sufixo único por chamada)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def processar_pedido(pedido: dict, max_geracoes: int = 1, pdf_pool: Executor | None = None) -> bool:
+    """
+    Processa um pedido: gera imagens via Gemini (1 fiel + 2 aventuras por foto, só as que faltam;
+    fotos quase iguais ganham outros temas em vez de repetir cenas, ver plano_paginas),
     monta PDF (ou usa o já gerado), envia email com anexo e marca como processado.
+    max_geracoes limita chamadas Gemini simultâneas do pedido; pdf_pool (ex.: ProcessPoolExecutor)
+    tira a montagem do PDF da thread atual. Retorna True se o pedido foi processado.
     Em falha (email ou geração), não atualiza o status (pedido será reprocessado).
+    Pedidos com imagens em lote aberto (batch.py) não são processados aqui: retorna False e
+    batch.py finaliza o pedido quando coletar o lote. Também retorna False, sem fazer nada, se outro
+    processo/thread tem o pedido reivindicado (store.claim_order).
     """
     order_id = pedido.get("order_id")
     if not order_id:
-        return
+        return False
+    dono = novo_dono()
+    if not store.claim_order(order_id, dono):
+        print(f"Pedido {order_id} já está em processamento (ou não está mais pendente); pulando", flush=True)
+        return False
     try:
-        pasta = store.UPLOADS_DIR / order_id
-        pet_name = pedido.get("pet_name", "")
-        file_names = pedido.get("file_names") or []
+        return _processar_reivindicado(pedido, dono, max_geracoes, pdf_pool)
+    finally:
+        store.release_order(order_id, dono)
 
-        file_names_validos = [
-            f for f in file_names
-            if (pasta / f).exists() and Path(f).suffix.lower() in EXTENSOES_IMAGEM
-        ]
-        for filename in file_names_validos:
-            path = pasta / filename
-            stem = path.stem
-            image_bytes = path.read_bytes()
 
-            # 1) Line art fiel
-            out_fiel = pasta / f"gerado_{stem}_fiel.png"
-            if not out_fiel.exists():
-                out_bytes = gerar_imagem(image_bytes, PROMPT_LINE_ART)
-                out_fiel.write_bytes(out_bytes)
-
-            # 2) Duas cenas de aventura (temas fixos v1: superhero, astronaut)
-            for i, (tema_id, _) in enumerate(TEMAS_AVENTURA_V1, start=1):
-                out_aventura = pasta / f"gerado_{stem}_aventura_{i}.png"
-                if not out_aventura.exists():
-                    prompt = prompt_aventura(tema_id, pet_name)
-                    out_bytes = gerar_imagem(image_bytes, prompt)
-                    out_aventura.write_bytes(out_bytes)
-
-        store.update_order_images_generated(order_id, True)
-
-        pdf_path = pasta / LIVRO_PDF_NAME
-        if pedido.get("pdf_generated") and pdf_path.exists():
-            pdf_bytes = pdf_path.read_bytes()
-        else:
-            pdf_bytes = b""
-            try:
-                pdf_bytes = gerar_pdf_pedido(pasta, pet_name, file_names_validos)
-                pdf_path.write_bytes(pdf_bytes)
-                store.update_order_pdf_generated(order_id, True)
-            except ValueError:
-                pass
-
-        enviar_email(pedido, pdf_bytes=pdf_bytes if pdf_bytes else None)
-        store.update_order_status(order_id, "processado")
-    except Exception as e:
-        msg = f"Pedido {order_id} - falha: {e}"
-        print(msg)
-        log_email(msg)
-
-
-def run() -> None:
-    pendentes = store.list_pending_production()
+def _processar_reivindicado(pedido: dict, dono: str, max_geracoes: int, pdf_pool: Executor | None) -> bool:
+    order_id = pedido["order_id"]
+    with profiling.order_trace(order_id):
+        metrics.ORDERS_IN_FLIGHT.inc()
+        try:
+            pasta = store.UPLOADS_DIR / order_id
+            pet_name = pedido.get("pet_name", "")
+            file_names_validos = fotos_validas(pedido)
+
+            if aguardando_lote(pedido):
+                print(f"Pedido {order_id} aguardando lote do Gemini; fica para batch.py", flush=True)
+                return False
+            plano = plano_paginas(pedido)
+            evitadas = geracoes_evitadas(pedido, plano)
+            anteriores = pedido.get("geracoes_evitadas", 0)
+            if evitadas != anteriores:
+                store.update_order_geracoes_evitadas(order_id, evitadas)
+                metrics.GENERATIONS_AVOIDED.inc(max(0, evitadas - anteriores))
+            _gerar_pendentes([g for g in plano if not g.destino.exists()], max_geracoes)
+            store.update_order_images_generated(order_id, True)
+            imagens = [g.destino for g in plano]
+            # Gerar é a parte longa: renova o lease; se expirou e outro assumiu, não manda email em dobro.
+            if not store.claim_order(order_id, dono):
+                raise RuntimeError("reivindicação do pedido perdida (lease expirou)")
+
+            pdf_path = pasta / LIVRO_PDF_NAME
+            if pedido.get("pdf_generated") and pdf_path.exists():
+                pdf_bytes = pdf_path.read_bytes()
+            else:
+                pdf_bytes = b""
+                try:
+                    with metrics.etapa("pdf"):
+                        if pdf_pool is None:
+                            pdf_bytes = gerar_pdf_pedido(pasta, pet_name, file_names_validos, imagens)
+                        else:
+                            pdf_bytes = pdf_pool.submit(
+                                gerar_pdf_pedido, pasta, pet_name, file_names_validos, imagens
+                            ).result()
+                    gravar_atomico(pdf_path, pdf_bytes)
+                    store.update_order_pdf_generated(order_id, True)
+                except ValueError:
+                    pass
+
+            with metrics.etapa("email"):
+                enviar_email(pedido, pdf_bytes=pdf_bytes if pdf_bytes else None)
+            store.update_order_status(order_id, "processado")
+            metrics.ORDERS_PROCESSED.inc(resultado="ok")
+            return True
+        except Exception as e:
+            metrics.ORDERS_PROCESSED.inc(resultado="falha")
+            msg = f"Pedido {order_id} - falha: {e}"
+            print(msg)
+            log_email(msg)
+            return False
+        finally:
+            metrics.ORDERS_IN_FLIGHT.dec()
+
+
+def filtrar_pedidos(
+    pedidos: list[dict],
+    ids: list[str] | None,
+    desde: str | None,
+    ate: str | None,
+    limite: int | None,
+) -> list[dict]:
+    """Filtra por order_id e por data de criação (YYYY-MM-DD, inclusivo); aplica limite."""
+    if ids:
+        wanted = set(ids)
+        pedidos = [p for p in pedidos if p["order_id"] in wanted]
+    if desde:
+        pedidos = [p for p in pedidos if p.get("created_at", "")[:10] >= desde]
+    if ate:
+        pedidos = [p for p in pedidos if p.get("created_at", "")[:10] <= ate]
+    return pedidos[:limite] if limite else pedidos
+
+
+def _fmt_duracao(segundos: float) -> str:
+    segundos = int(segundos)
+    h, resto = divmod(segundos, 3600)
+    m, s = divmod(resto, 60)
+    return f"{h}h{m:02d}m" if h else f"{m}m{s:02d}s"
+
+
+class _Progresso:
+    """Contagem de pedidos concluídos com vazão e ETA, impressa em stderr a cada conclusão."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.ok = 0
+        self.falhas = 0
+        self.inicio = time.monotonic()
+        self._lock = threading.Lock()
+
+    def concluir(self, order_id: str, sucesso: bool) -> None:
+        with self._lock:
+            if sucesso:
+                self.ok += 1
+            else:
+                self.falhas += 1
+            feitos = self.ok + self.falhas
+            decorrido = time.monotonic() - self.inicio
+            eta = decorrido / feitos * (self.total - feitos)
+            print(
+                f"[{feitos}/{self.total}] ok={self.ok} falha={self.falhas} "
+                f"{feitos / decorrido * 60:.1f} pedidos/min  decorrido {_fmt_duracao(decorrido)}  "
+                f"ETA {_fmt_duracao(eta)}  ({order_id} {'ok' if sucesso else 'FALHA'})",
+                file=sys.stderr,
+                flush=True,
+            )
+
+
+def run(
+    pedidos_paralelos: int = 1,
+    geracoes_paralelas: int = 1,
+    ids: list[str] | None = None,
+    desde: str | None = None,
+    ate: str | None = None,
+    limite: int | None = None,
+    dry_run: bool = False,
+    max_gasto: float | None = None,
+    custo_imagem: float = 0.0,
+    pdf_processos: int | None = None,
+) -> int:
+    """
+    Processa pedidos pendentes (mais antigos primeiro). max_gasto, se definido, para de agendar
+    pedidos quando o custo estimado (gerações pendentes x custo_imagem) ultrapassaria o limite.
+    Retorna a quantidade de pedidos com falha.
+    """
+    pendentes = filtrar_pedidos(store.list_pending_production(), ids, desde, ate, limite)
+    reivindicados = [p for p in pendentes if store.claim_ativo(p)]
+    if reivindicados:
+        print(f"{len(reivindicados)} pedido(s) já em processamento em outro lugar ficam de fora.", file=sys.stderr)
+        pendentes = [p for p in pendentes if p not in reivindicados]
+    em_lote = [p for p in pendentes if aguardando_lote(p)]
+    if em_lote:
+        print(f"{len(em_lote)} pedido(s) aguardando lote do Gemini ficam para batch.py.", file=sys.stderr)
+        pendentes = [p for p in pendentes if p not in em_lote]
     if not pendentes:
-        return
+        return 0
+
+    agendados: list[dict] = []
+    gasto = 0.0
+    geracoes_total = 0
     for pedido in pendentes:
-        processar_pedido(pedido)
+        n_geracoes = len(geracoes_pendentes(pedido))
+        custo = n_geracoes * custo_imagem
+        if max_gasto is not None and gasto + custo > max_gasto:
+            print(
+                f"Limite de gasto {max_gasto:.2f} atingido: {len(pendentes) - len(agendados)} "
+                "pedido(s) ficam para a próxima execução.",
+                file=sys.stderr,
+            )
+            break
+        gasto += custo
+        geracoes_total += n_geracoes
+        agendados.append(pedido)
+        if dry_run:
+            print(f"{pedido['order_id']}  {pedido.get('created_at', '')}  "
+                  f"gerações pendentes={n_geracoes}  custo≈{custo:.2f}")
+
+    print(
+        f"{len(agendados)} pedido(s), {geracoes_total} geração(ões) pendente(s), custo estimado {gasto:.2f}",
+        file=sys.stderr,
+    )
+    if dry_run or not agendados:
+        return 0
+
+    progresso = _Progresso(len(agendados))
+
+    def _um(pedido: dict, pdf_pool: Executor | None) -> None:
+        ok = processar_pedido(pedido, max_geracoes=geracoes_paralelas, pdf_pool=pdf_pool)
+        progresso.concluir(pedido["order_id"], ok)
+
+    if pedidos_paralelos <= 1:
+        for pedido in agendados:
+            _um(pedido, None)
+        return progresso.falhas
+
+    # PDF é CPU (decode/encode de imagens): processos separados usam todos os núcleos.
+    n_processos = pdf_processos or min(os.cpu_count() or 1, pedidos_paralelos)
+    with ProcessPoolExecutor(max_workers=n_processos) as pdf_pool, \
+            ThreadPoolExecutor(max_workers=pedidos_paralelos) as pool:
+        for future in [pool.submit(_um, pedido, pdf_pool) for pedido in agendados]:
+            future.result()
+    return progresso.falhas
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Processa (drena) pedidos pagos pendentes: gera imagens, PDF e envia email."
+    )
+    parser.add_argument("--pedidos-paralelos", type=int, default=1, help="pedidos processados ao mesmo tempo")
+    parser.add_argument("--geracoes-paralelas", type=int, default=1, help="chamadas Gemini simultâneas por pedido")
+    parser.add_argument("--pdf-processos", type=int, default=None,
+                        help="processos para montar PDFs (default: núcleos, até --pedidos-paralelos)")
+    parser.add_argument("--pedido", action="append", dest="ids", metavar="ORDER_ID",
+                        help="processa só este pedido (pode repetir)")
+    parser.add_argument("--desde", metavar="YYYY-MM-DD", help="pedidos criados a partir desta data")
+    parser.add_argument("--ate", metavar="YYYY-MM-DD", help="pedidos criados até esta data")
+    parser.add_argument("--limite", type=int, default=None, help="máximo de pedidos nesta execução")
+    parser.add_argument("--dry-run", action="store_true", help="só lista pedidos, gerações e custo estimado")
+    parser.add_argument("--max-gasto", type=float, default=None,
+                        help="para de agendar pedidos quando o custo estimado passar deste valor")
+    parser.add_argument("--custo-imagem", type=float,
+                        default=float(os.getenv("GEMINI_CUSTO_IMAGEM", "0.04")),
+                        help="custo estimado por geração (default: GEMINI_CUSTO_IMAGEM ou 0.04)")
+    args = parser.parse_args(argv)
+    falhas = run(
+        pedidos_paralelos=args.pedidos_paralelos,
+        geracoes_paralelas=args.geracoes_paralelas,
+        ids=args.ids,
+        desde=args.desde,
+        ate=args.ate,
+        limite=args.limite,
+        dry_run=args.dry_run,
+        max_gasto=args.max_gasto,
+        custo_imagem=args.custo_imagem,
+        pdf_processos=args.pdf_processos,
+    )
+    return 1 if falhas else 0
 
 
 if __name__ == "__main__":
-    run()
+    sys.exit(main())
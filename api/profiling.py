@@ -0,0 +1,166 @@
+"""
+Profiling opt-in: spans aninhados por pedido (Chrome trace JSON) e cProfile do event loop.
+Arquivos vão para PROFILE_DIR (default api/traces): abra os .json em chrome://tracing ou
+ui.perfetto.dev e os .prof com snakeviz/flameprof.
+
+Ativação:
+- PROFILE_ORDERS=true: grava trace de todo processar_pedido.
+- PROFILE_REQUESTS=true: perfila todas as requisições da API (cProfile + spans).
+- Header X-PetStory-Profile com o valor de PROFILE_TOKEN: perfila só aquela requisição
+  (e o pedido enfileirado por ela, no caso do webhook). Sem PROFILE_TOKEN o header é ignorado.
+Sem trace ativo, span() custa uma leitura de ContextVar.
+
+Limite do .prof de requisição: o cProfile fica ligado na thread do event loop enquanto a requisição
+está em andamento. Ele inclui o que outras requisições executaram no loop nesse intervalo e não
+vê código em threadpool (endpoints síncronos, run_in_threadpool, fila de processamento). Leia como
+amostra do event loop naquela janela, não como custo da requisição; para custo por etapa use os spans.
+"""
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+PROFILE_HEADER = "x-petstory-profile"
+
+_trace_atual: ContextVar["_Trace | None"] = ContextVar("petstory_trace", default=None)
+# Só um cProfile pode estar ativo por processo; requisições concorrentes ficam só com spans.
+_cprofile_lock = threading.Lock()
+
+
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "false").strip().lower() in ("true", "1")
+
+
+def profile_dir() -> Path:
+    raw = os.getenv("PROFILE_DIR", "").strip()
+    return Path(raw) if raw else Path(__file__).resolve().parent / "traces"
+
+
+def _nome_arquivo(*partes: str) -> str:
+    base = "-".join(re.sub(r"[^A-Za-z0-9_.]+", "_", p).strip("_") for p in partes if p)
+    return f"{base}-{time.strftime('%Y%m%d-%H%M%S')}-{time.perf_counter_ns() % 1_000_000:06d}"
+
+
+class _Trace:
+    """Coleta eventos 'X' (complete) no formato Chrome trace."""
+
+    def __init__(self, nome: str):
+        self.nome = nome
+        self.eventos: list[dict] = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def add(self, name: str, inicio_ns: int, fim_ns: int, args: dict) -> None:
+        evento = {
+            "name": name,
+            "cat": "petstory",
+            "ph": "X",
+            "ts": inicio_ns / 1000,
+            "dur": (fim_ns - inicio_ns) / 1000,
+            "pid": self._pid,
+            "tid": threading.get_ident(),
+        }
+        if args:
+            evento["args"] = {k: str(v) for k, v in args.items()}
+        with self._lock:
+            self.eventos.append(evento)
+
+    def dump(self) -> Path:
+        pasta = profile_dir()
+        pasta.mkdir(parents=True, exist_ok=True)
+        path = pasta / f"{_nome_arquivo(self.nome)}.json"
+        with self._lock:
+            data = {"traceEvents": sorted(self.eventos, key=lambda e: e["ts"]), "displayTimeUnit": "ms"}
+        path.write_text(json.dumps(data), encoding="utf-8")
+        return path
+
+
+def ativo() -> bool:
+    """True se há um trace coletando spans no contexto atual."""
+    return _trace_atual.get() is not None
+
+
+@contextmanager
+def span(name: str, **args):
+    """Registra um span no trace do contexto atual; no-op se não houver trace ativo."""
+    trace = _trace_atual.get()
+    if trace is None:
+        yield
+        return
+    inicio = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        trace.add(name, inicio, time.perf_counter_ns(), args)
+
+
+@contextmanager
+def _trace(nome: str, root_span: str, **args):
+    trace = _Trace(nome)
+    token = _trace_atual.set(trace)
+    try:
+        with span(root_span, **args):
+            yield trace
+    finally:
+        _trace_atual.reset(token)
+        try:
+            trace.dump()
+        except OSError as e:
+            print(f"Profiling: falha ao gravar trace {nome}: {e}", flush=True)
+
+
+@contextmanager
+def order_trace(order_id: str, forcar: bool = False):
+    """
+    Trace de um pedido (processar_pedido e etapas internas). Se o pedido já tem trace aberto
+    no contexto (ex.: aberto pelo webhook perfilado), vira apenas um span dentro dele.
+    """
+    nome = f"order-{order_id}"
+    atual = _trace_atual.get()
+    if atual is not None and atual.nome == nome:
+        with span("processar_pedido", order_id=order_id):
+            yield
+        return
+    if not (forcar or _env_flag("PROFILE_ORDERS")):
+        yield
+        return
+    with _trace(nome, "pedido", order_id=order_id):
+        yield
+
+
+def request_profiling_enabled(header_value: str | None) -> bool:
+    """True se a requisição deve ser perfilada (PROFILE_REQUESTS ou header com PROFILE_TOKEN)."""
+    if _env_flag("PROFILE_REQUESTS"):
+        return True
+    token = os.getenv("PROFILE_TOKEN", "").strip()
+    return bool(token) and (header_value or "").strip() == token
+
+
+@contextmanager
+def request_profile(method: str, path: str):
+    """
+    Perfila uma requisição: spans em Chrome trace JSON e, se livre, cProfile do event loop em
+    .loop.prof durante a requisição (inclui outras requisições concorrentes; ver docstring do módulo).
+    """
+    nome = f"request-{method}-{path}"
+    profiler = cProfile.Profile() if _cprofile_lock.acquire(blocking=False) else None
+    try:
+        if profiler is not None:
+            profiler.enable()
+        with _trace(nome, f"{method} {path}"):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _cprofile_lock.release()
+            try:
+                pasta = profile_dir()
+                pasta.mkdir(parents=True, exist_ok=True)
+                profiler.dump_stats(str(pasta / f"{_nome_arquivo(nome)}.loop.prof"))
+            except OSError as e:
+                print(f"Profiling: falha ao gravar cProfile {nome}: {e}", flush=True)
@@ -1,12 +1,75 @@
 """Armazenamento simples de pedidos em JSON (MVP)."""
 import json
+import os
+import threading
 import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 
-DATA_DIR = Path(__file__).resolve().parent / "data"
+from metrics import STORE_SECONDS, cronometrar
+
+try:
+    import fcntl
+except ImportError:  # Windows: só o lock entre threads
+    fcntl = None
+
+# PETSTORY_DATA_DIR / PETSTORY_UPLOADS_DIR permitem isolar dados (ex.: loadtest.py).
+DATA_DIR = Path(os.getenv("PETSTORY_DATA_DIR") or Path(__file__).resolve().parent / "data")
 ORDERS_FILE = DATA_DIR / "orders.json"
-UPLOADS_DIR = Path(__file__).resolve().parent / "uploads"
+UPLOADS_DIR = Path(os.getenv("PETSTORY_UPLOADS_DIR") or Path(__file__).resolve().parent / "uploads")
+# Camada fria (archive.py): pedidos antigos já processados saem do orders.json.
+ARCHIVE_DIR = DATA_DIR / "archive"
+ARCHIVE_INDEX = ARCHIVE_DIR / "index.json"
+# Manifestos dos lotes abertos do Gemini (batch.py).
+BATCHES_DIR = DATA_DIR / "batches"
+# Lease de quem processa um pedido (claim_order): expirado, outro processo pode assumir o pedido.
+CLAIM_LEASE_SECONDS = int(os.getenv("PROCESS_LEASE_SECONDS") or 3600)
+
+LOCK_FILE = DATA_DIR / "orders.lock"
+
+# Serializa leitura-modificação-escrita do orders.json entre threads (API e process.py paralelo)
+# e, via flock em LOCK_FILE, entre processos (API, process.py, archive.py, batch.py).
+_lock = threading.RLock()
+_lock_fd = None
+_lock_profundidade = 0
+
+
+@contextmanager
+def _lock_entre_processos():
+    """flock exclusivo em LOCK_FILE; reentrante (chamar só com _lock em mãos)."""
+    global _lock_fd, _lock_profundidade
+    if fcntl is not None and _lock_profundidade == 0:
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        _lock_fd = open(LOCK_FILE, "a+b")
+        try:
+            fcntl.flock(_lock_fd, fcntl.LOCK_EX)
+        except BaseException:
+            _lock_fd.close()
+            _lock_fd = None
+            raise
+    _lock_profundidade += 1
+    try:
+        yield
+    finally:
+        _lock_profundidade -= 1
+        if _lock_fd is not None and _lock_profundidade == 0:
+            fcntl.flock(_lock_fd, fcntl.LOCK_UN)
+            _lock_fd.close()
+            _lock_fd = None
+
+
+def _operacao(nome: str):
+    """Decorator das operações públicas: executa sob _lock (+ flock entre processos) e mede em STORE_SECONDS."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _lock, _lock_entre_processos():
+                return fn(*args, **kwargs)
+        return cronometrar(STORE_SECONDS, op=nome)(wrapper)
+    return decorator
 
 
 def _ensure_dirs() -> None:
@@ -21,11 +84,50 @@ def _load_orders() -> dict:
     return json.loads(ORDERS_FILE.read_text(encoding="utf-8"))
 
 
+def _write_json(path: Path, data: dict, indent: int | None = 2) -> None:
+    """Escreve em arquivo temporário e troca atomicamente: leitores nunca veem JSON pela metade."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=indent), encoding="utf-8")
+    os.replace(tmp, path)
+
+
 def _save_orders(orders: dict) -> None:
     _ensure_dirs()
-    ORDERS_FILE.write_text(json.dumps(orders, ensure_ascii=False, indent=2), encoding="utf-8")
+    _write_json(ORDERS_FILE, orders)
+
+
+# Arquivos da camada fria mudam raramente: cache em memória invalidado por mtime/tamanho, LRU de
+# ARCHIVE_CACHE_FILES arquivos (índice + meses mais consultados) para não trazer o arquivo frio todo à memória.
+COLD_CACHE_MAX = max(1, int(os.getenv("ARCHIVE_CACHE_FILES") or 4))
+_cold_cache: OrderedDict[Path, tuple[tuple[int, int], dict]] = OrderedDict()
+
 
+def _read_cold(path: Path) -> dict:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return {}
+    versao = (st.st_mtime_ns, st.st_size)
+    cached = _cold_cache.get(path)
+    if cached and cached[0] == versao:
+        _cold_cache.move_to_end(path)
+        return cached[1]
+    data = json.loads(path.read_text(encoding="utf-8"))
+    _cold_cache[path] = (versao, data)
+    _cold_cache.move_to_end(path)
+    while len(_cold_cache) > COLD_CACHE_MAX:
+        _cold_cache.popitem(last=False)
+    return data
 
+
+def _get_archived(order_id: str) -> dict | None:
+    entrada = _read_cold(ARCHIVE_INDEX).get(order_id)
+    if not entrada:
+        return None
+    return _read_cold(ARCHIVE_DIR / entrada["orders_file"]).get(order_id)
+
+
+@_operacao("create_order")
 def create_order(pet_name: str, user_email: str, file_names: list[str]) -> str:
     """Cria pedido com pagamento e status pendentes. Retorna order_id."""
     orders = _load_orders()
@@ -44,6 +146,7 @@ def create_order(pet_name: str, user_email: str, file_names: list[str]) -> str:
     return order_id
 
 
+@_operacao("list_pending_production")
 def list_pending_production() -> list[dict]:
     """Retorna pedidos com pagamento ok e status pendente, ordenados por created_at (mais antigo primeiro)."""
     orders = _load_orders()
@@ -56,12 +159,64 @@ def list_pending_production() -> list[dict]:
     return pending
 
 
+@_operacao("list_processed")
+def list_processed() -> list[dict]:
+    """Retorna pedidos com status processado (camada quente)."""
+    orders = _load_orders()
+    return [{**o, "order_id": oid} for oid, o in orders.items() if o.get("status") == "processado"]
+
+
+def _agora_iso() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def claim_ativo(order: dict, owner: str | None = None) -> bool:
+    """True se o pedido está reivindicado por outro dono (≠ owner) com lease ainda válido."""
+    claim = order.get("claim")
+    return bool(claim) and claim.get("owner") != owner and claim.get("until", "") > _agora_iso()
+
+
+@_operacao("claim_order")
+def claim_order(order_id: str, owner: str, lease_seconds: int | None = None) -> bool:
+    """
+    Reivindica um pedido pago e pendente para processamento, ou renova o lease se owner já é o dono.
+    Retorna False se o pedido não está pendente ou se outro dono tem lease válido.
+    """
+    orders = _load_orders()
+    order = orders.get(order_id)
+    if not order or order.get("pagamento") != "ok" or order.get("status") != "pendente":
+        return False
+    if claim_ativo(order, owner):
+        return False
+    lease = CLAIM_LEASE_SECONDS if lease_seconds is None else lease_seconds
+    order["claim"] = {
+        "owner": owner,
+        "until": (datetime.utcnow() + timedelta(seconds=lease)).isoformat() + "Z",
+    }
+    _save_orders(orders)
+    return True
+
+
+@_operacao("release_order")
+def release_order(order_id: str, owner: str) -> bool:
+    """Libera o pedido se owner ainda é o dono. Retorna True se liberou."""
+    orders = _load_orders()
+    order = orders.get(order_id)
+    if not order or (order.get("claim") or {}).get("owner") != owner:
+        return False
+    del order["claim"]
+    _save_orders(orders)
+    return True
+
+
+@_operacao("get_order")
 def get_order(order_id: str) -> dict | None:
-    """Retorna pedido ou None se não existir."""
+    """Retorna pedido (buscando também na camada fria, se arquivado) ou None se não existir."""
     orders = _load_orders()
-    return orders.get(order_id)
+    return orders.get(order_id) or _get_archived(order_id)
 
 
+@_operacao("get_order_by_asaas_checkout_id")
 def get_order_by_asaas_checkout_id(checkout_id: str) -> dict | None:
     """Retorna o pedido que possui o asaas_checkout_id dado, ou None."""
     orders = _load_orders()
@@ -71,6 +226,7 @@ def get_order_by_asaas_checkout_id(checkout_id: str) -> dict | None:
     return None
 
 
+@_operacao("update_order_asaas_checkout_id")
 def update_order_asaas_checkout_id(order_id: str, checkout_id: str) -> bool:
     """Associa o id do checkout Asaas ao pedido. Retorna True se existir."""
     orders = _load_orders()
@@ -81,6 +237,7 @@ def update_order_asaas_checkout_id(order_id: str, checkout_id: str) -> bool:
     return True
 
 
+@_operacao("update_order_pagamento")
 def update_order_pagamento(order_id: str, valor: str) -> bool:
     """Atualiza o campo pagamento do pedido (ex.: 'ok', 'pendente'). Retorna True se existir."""
     orders = _load_orders()
@@ -92,6 +249,7 @@ def update_order_pagamento(order_id: str, valor: str) -> bool:
     return True
 
 
+@_operacao("update_order_status")
 def update_order_status(order_id: str, status: str) -> bool:
     """Atualiza status do pedido. Retorna True se existir."""
     orders = _load_orders()
@@ -103,16 +261,22 @@ def update_order_status(order_id: str, status: str) -> bool:
     return True
 
 
-def update_order_file_names(order_id: str, file_names: list[str]) -> bool:
-    """Atualiza lista de arquivos do pedido."""
+@_operacao("update_order_file_names")
+def update_order_file_names(
+    order_id: str, file_names: list[str], phashes: dict[str, str | None] | None = None
+) -> bool:
+    """Atualiza lista de arquivos do pedido e, se informados, os hashes perceptuais (nome -> dHash hex)."""
     orders = _load_orders()
     if order_id not in orders:
         return False
     orders[order_id]["file_names"] = file_names
+    if phashes is not None:
+        orders[order_id]["phashes"] = phashes
     _save_orders(orders)
     return True
 
 
+@_operacao("update_order_images_generated")
 def update_order_images_generated(order_id: str, value: bool) -> bool:
     """Marca se as imagens (gerado_*.png) já foram geradas para o pedido."""
     orders = _load_orders()
@@ -123,6 +287,7 @@ def update_order_images_generated(order_id: str, value: bool) -> bool:
     return True
 
 
+@_operacao("update_order_pdf_generated")
 def update_order_pdf_generated(order_id: str, value: bool) -> bool:
     """Marca se o PDF do pedido já foi gerado."""
     orders = _load_orders()
@@ -131,3 +296,54 @@ def update_order_pdf_generated(order_id: str, value: bool) -> bool:
     orders[order_id]["pdf_generated"] = value
     _save_orders(orders)
     return True
+
+
+@_operacao("update_order_geracoes_evitadas")
+def update_order_geracoes_evitadas(order_id: str, value: int) -> bool:
+    """Registra quantas gerações foram poupadas por fotos quase iguais."""
+    orders = _load_orders()
+    if order_id not in orders:
+        return False
+    orders[order_id]["geracoes_evitadas"] = value
+    _save_orders(orders)
+    return True
+
+
+@_operacao("archive_orders")
+def archive_orders(entradas: dict[str, dict]) -> list[str]:
+    """
+    Move pedidos processados do orders.json para a camada fria. entradas[order_id] é a entrada do
+    índice (precisa de "orders_file", arquivo mensal em ARCHIVE_DIR). Pedidos que não estão mais
+    com status processado são ignorados. Retorna os order_ids arquivados.
+    """
+    orders = _load_orders()
+    movidos = [
+        oid for oid in entradas
+        if oid in orders and orders[oid].get("status") == "processado"
+    ]
+    if not movidos:
+        return []
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    por_arquivo: dict[str, list[str]] = {}
+    for oid in movidos:
+        por_arquivo.setdefault(entradas[oid]["orders_file"], []).append(oid)
+    # Ordem pensada para falhas: camada fria e índice primeiro; se cair antes de salvar o orders.json,
+    # o pedido só fica duplicado (get_order prefere o quente) e a próxima execução conclui.
+    for nome, oids in por_arquivo.items():
+        path = ARCHIVE_DIR / nome
+        mensal = dict(_read_cold(path))
+        mensal.update({oid: orders[oid] for oid in oids})
+        _write_json(path, mensal, indent=None)
+    index = dict(_read_cold(ARCHIVE_INDEX))
+    index.update({oid: entradas[oid] for oid in movidos})
+    _write_json(ARCHIVE_INDEX, index, indent=None)
+    for oid in movidos:
+        del orders[oid]
+    _save_orders(orders)
+    return movidos
+
+
+@_operacao("get_archive_entry")
+def get_archive_entry(order_id: str) -> dict | None:
+    """Entrada do índice da camada fria (orders_file, zip, archived_at) ou None se não arquivado."""
+    return _read_cold(ARCHIVE_INDEX).get(order_id)
@@ -1,12 +1,35 @@
+import os
+import re
 import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
 
 import yaml
 from pydantic import BaseModel
 
+import metrics
 
-TELEMETRY_DB = Path(__file__).parent / "telemetry.db"
+
+TELEMETRY_DB = Path(os.getenv("TELEMETRY_DB") or Path(__file__).parent / "telemetry.db")
+
+
+# Ingest filtering (applied by the API before save_event):
+# - TELEMETRY_BOT_UA_PATTERN: regex matched against the user agent (case-insensitive).
+# - TELEMETRY_DEDUP_SECONDS / TELEMETRY_DEDUP_MAX: window and capacity of the in-memory
+#   (session_id, event_name, path) dedup; TELEMETRY_DEDUP_EVENTS lists event names to dedup ("*" = all).
+# - TELEMETRY_SAMPLE_RATES: per-event sampling, e.g. "page_exit=0.1,scroll_25=0.5". The rate is
+#   stored with each row so get_summary can re-weight counts. SESSION_EVENTS are never sampled:
+#   every session sends one on page load, so get_unique_sessions can count them exactly.
+DEFAULT_BOT_UA_PATTERN = (
+    r"bot|crawl|spider|slurp|scrap|headless|lighthouse|pagespeed|preview|monitor|uptime|"
+    r"facebookexternalhit|embedly|python-requests|python-urllib|aiohttp|httpx|curl|wget|go-http-client|okhttp|java/"
+)
+DEFAULT_DEDUP_EVENTS = "page_view,scroll_25,scroll_50,scroll_75,scroll_100,offer_seen,page_exit"
+SESSION_EVENTS = frozenset({"page_view"})
 
 
 class TelemetryEvent(BaseModel):
@@ -24,6 +47,8 @@ class TelemetryEvent(BaseModel):
 def init_db():
     """Initialize the SQLite database and create table if not exists."""
     conn = sqlite3.connect(str(TELEMETRY_DB))
+    # WAL (persists in the file): readers, including backup.py's online copy, don't block writers.
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS telemetry_events (
@@ -37,9 +62,13 @@ def init_db():
             screen_width INTEGER,
             screen_height INTEGER,
             metadata_json TEXT,
+            sample_rate REAL DEFAULT 1.0,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(telemetry_events)")}
+    if "sample_rate" not in columns:
+        cursor.execute("ALTER TABLE telemetry_events ADD COLUMN sample_rate REAL DEFAULT 1.0")
     cursor.execute(
         "CREATE INDEX IF NOT EXISTS idx_session ON telemetry_events(session_id)"
     )
@@ -50,15 +79,86 @@ def init_db():
     conn.close()
 
 
-def save_event(event: TelemetryEvent):
-    """Save a telemetry event to the database."""
+class _DedupWindow:
+    """Bounded LRU of recently seen keys; a key repeated within `seconds` is a duplicate."""
+
+    def __init__(self, seconds: float, max_keys: int):
+        self.seconds = seconds
+        self.max_keys = max_keys
+        self._seen: OrderedDict[tuple, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, key: tuple) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            last = self._seen.pop(key, None)
+            self._seen[key] = now
+            if len(self._seen) > self.max_keys:
+                self._seen.popitem(last=False)
+        return last is not None and now - last < self.seconds
+
+
+def _parse_sample_rates(raw: str) -> dict[str, float]:
+    rates = {}
+    for item in raw.split(","):
+        name, _, value = item.partition("=")
+        try:
+            rate = float(value)
+        except ValueError:
+            continue
+        if name.strip() and name.strip() not in SESSION_EVENTS and 0 < rate <= 1:
+            rates[name.strip()] = rate
+    return rates
+
+
+_bot_ua = re.compile(os.getenv("TELEMETRY_BOT_UA_PATTERN") or DEFAULT_BOT_UA_PATTERN, re.IGNORECASE)
+_dedup_events = {
+    e.strip() for e in (os.getenv("TELEMETRY_DEDUP_EVENTS") or DEFAULT_DEDUP_EVENTS).split(",") if e.strip()
+}
+_dedup = _DedupWindow(
+    seconds=float(os.getenv("TELEMETRY_DEDUP_SECONDS") or 1800),
+    max_keys=int(os.getenv("TELEMETRY_DEDUP_MAX") or 50_000),
+)
+_sample_rates = _parse_sample_rates(os.getenv("TELEMETRY_SAMPLE_RATES", ""))
+
+
+def _sampled_in(event: TelemetryEvent, rate: float) -> bool:
+    """Deterministic per (session, event): a session is either fully in or out for that event."""
+    bucket = zlib.crc32(f"{event.session_id}:{event.event_name}".encode("utf-8")) / 0xFFFFFFFF
+    return bucket < rate
+
+
+def filter_event(event: TelemetryEvent, header_user_agent: str | None = None) -> float | None:
+    """
+    Ingest filter: returns the sample rate to store the event with, or None if it must be dropped
+    (bot user agent, duplicate within the dedup window, or sampled out).
+    """
+    user_agent = event.user_agent or header_user_agent or ""
+    if not user_agent or _bot_ua.search(user_agent):
+        metrics.TELEMETRY_EVENTS.inc(resultado="bot")
+        return None
+    rate = _sample_rates.get(event.event_name, 1.0)
+    if rate < 1.0 and not _sampled_in(event, rate):
+        metrics.TELEMETRY_EVENTS.inc(resultado="fora_da_amostra")
+        return None
+    if ("*" in _dedup_events or event.event_name in _dedup_events) and _dedup.is_duplicate(
+        (event.session_id, event.event_name, event.path)
+    ):
+        metrics.TELEMETRY_EVENTS.inc(resultado="duplicado")
+        return None
+    metrics.TELEMETRY_EVENTS.inc(resultado="gravado")
+    return rate
+
+
+def save_event(event: TelemetryEvent, sample_rate: float = 1.0):
+    """Save a telemetry event to the database (sample_rate < 1 when the event was sampled)."""
     conn = sqlite3.connect(str(TELEMETRY_DB))
     cursor = conn.cursor()
     cursor.execute(
         """
         INSERT INTO telemetry_events 
-        (session_id, event_name, path, timestamp, referrer, user_agent, screen_width, screen_height, metadata_json)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        (session_id, event_name, path, timestamp, referrer, user_agent, screen_width, screen_height, metadata_json, sample_rate)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
             event.session_id,
@@ -70,6 +170,7 @@ def save_event(event: TelemetryEvent):
             event.screen_width,
             event.screen_height,
             str(event.metadata) if event.metadata else "{}",
+            sample_rate,
         ),
     )
     conn.commit()
@@ -77,11 +178,11 @@ def save_event(event: TelemetryEvent):
 
 
 def get_summary() -> dict:
-    """Get summary of events grouped by event_name."""
+    """Get summary of events grouped by event_name (sampled events re-weighted by 1/sample_rate)."""
     conn = sqlite3.connect(str(TELEMETRY_DB))
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT event_name, COUNT(*) as count 
+        SELECT event_name, CAST(ROUND(SUM(1.0 / COALESCE(sample_rate, 1.0))) AS INTEGER) as count
         FROM telemetry_events 
         GROUP BY event_name 
         ORDER BY count DESC
@@ -92,10 +193,15 @@ def get_summary() -> dict:
 
 
 def get_unique_sessions() -> int:
-    """Get count of unique sessions."""
+    """
+    Get count of unique sessions. Only unsampled rows are counted: a session whose other events were
+    all sampled out still has its (never sampled) SESSION_EVENTS row, and sampled rows add nothing.
+    """
     conn = sqlite3.connect(str(TELEMETRY_DB))
     cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(DISTINCT session_id) FROM telemetry_events")
+    cursor.execute(
+        "SELECT COUNT(DISTINCT session_id) FROM telemetry_events WHERE COALESCE(sample_rate, 1.0) >= 1.0"
+    )
     result = cursor.fetchone()[0]
     conn.close()
     return result
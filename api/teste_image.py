@@ -3,6 +3,10 @@ from google.genai import types
 from PIL import Image
 from dotenv import load_dotenv
 import os
+import sys
+if len(sys.argv) != 2:
+    sys.exit("Uso: python teste_image.py caminho/da/foto.jpg")
+
 load_dotenv()
 client = genai.Client()
 
@@ -16,7 +20,7 @@ PROMPT_LINE_ART = (
     "OUTPUT: Clean, printable coloring book page."
 )
 
-filename = r"/home/mateus/Images/dog1.jpg"
+filename = sys.argv[1]
 image = Image.open(filename)
 
 response = client.models.generate_content(
@@ -0,0 +1,120 @@
+"""Controle de admissão: limites de taxa e de uploads, fila adaptativa e IP do cliente."""
+import os
+import sys
+import threading
+import unittest
+from contextlib import ExitStack
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import admission  # noqa: E402
+
+
+class LimiteTaxaTest(unittest.TestCase):
+    def test_rajada_e_depois_espera(self):
+        limite = admission.LimiteTaxa(por_minuto=60, rajada=3)
+        self.assertEqual([limite.consumir("a") for _ in range(3)], [0.0, 0.0, 0.0])
+        espera = limite.consumir("a")
+        self.assertGreater(espera, 0)
+        self.assertLessEqual(espera, 1.0)
+
+    def test_clientes_independentes(self):
+        limite = admission.LimiteTaxa(por_minuto=60, rajada=1)
+        self.assertEqual(limite.consumir("a"), 0.0)
+        self.assertEqual(limite.consumir("b"), 0.0)
+        self.assertGreater(limite.consumir("a"), 0)
+
+    def test_taxa_zero_desativa(self):
+        limite = admission.LimiteTaxa(por_minuto=0)
+        self.assertTrue(all(limite.consumir("a") == 0.0 for _ in range(100)))
+
+    def test_lru_limita_clientes(self):
+        limite = admission.LimiteTaxa(por_minuto=60, rajada=1, max_clientes=2)
+        for cliente in ("a", "b", "c"):
+            limite.consumir(cliente)
+        self.assertEqual(list(limite._buckets), ["b", "c"])
+        self.assertEqual(limite.consumir("a"), 0.0)  # esquecido: rajada cheia de novo
+
+
+class LimiteUploadsTest(unittest.TestCase):
+    def test_limite_de_uploads_simultaneos(self):
+        limite = admission.LimiteUploads(max_uploads=2, max_bytes=10**9)
+        with limite.admitir(1), limite.admitir(1):
+            with self.assertRaises(admission.Rejeitado):
+                with limite.admitir(1):
+                    pass
+        with limite.admitir(1):
+            pass
+
+    def test_limite_de_bytes_e_upload_sozinho_passa(self):
+        limite = admission.LimiteUploads(max_uploads=10, max_bytes=100)
+        with limite.admitir(500):  # sozinho passa mesmo acima de max_bytes
+            with self.assertRaises(admission.Rejeitado):
+                with limite.admitir(1):
+                    pass
+        with ExitStack() as stack:
+            stack.enter_context(limite.admitir(60))
+            with self.assertRaises(admission.Rejeitado):
+                stack.enter_context(limite.admitir(60))
+            stack.enter_context(limite.admitir(40))
+
+
+class FilaProcessamentoTest(unittest.TestCase):
+    def _fila(self, **kwargs) -> tuple[admission.FilaProcessamento, threading.Event, list[str]]:
+        liberar = threading.Event()
+        processados: list[str] = []
+
+        def processar(pedido: dict, trace: bool) -> bool:
+            liberar.wait(5)
+            processados.append(pedido["order_id"])
+            return True
+
+        fila = admission.FilaProcessamento(processar, workers=1, varredura_s=0, **kwargs)
+        return fila, liberar, processados
+
+    def test_deduplica_e_recusa_quando_cheia(self):
+        fila, liberar, processados = self._fila(capacidade_max=2)
+        self.assertTrue(fila.enfileirar({"order_id": "a"}))
+        self.assertFalse(fila.enfileirar({"order_id": "a"}))  # reenvio do webhook
+        self.assertTrue(fila.enfileirar({"order_id": "b"}))
+        with self.assertRaises(admission.Rejeitado) as ctx:
+            fila.enfileirar({"order_id": "c"})
+        self.assertEqual(ctx.exception.status, 429)
+        fila.start()
+        liberar.set()
+        fila.stop()
+        self.assertEqual(processados, ["a", "b"])
+
+    def test_capacidade_se_adapta_a_vazao(self):
+        fila = admission.FilaProcessamento(lambda p, t: True, workers=2, capacidade_max=100, espera_alvo_s=60)
+        self.assertEqual(fila.capacidade(), 100)
+        fila._segundos_por_pedido = 30.0  # 2 workers x 2 pedidos/min x 1 min
+        self.assertEqual(fila.capacidade(), 4)
+        fila._segundos_por_pedido = 3600.0
+        self.assertEqual(fila.capacidade(), fila.workers)  # nunca abaixo do número de workers
+
+    def test_varrer_para_quando_a_fila_enche(self):
+        pendentes = [{"order_id": str(i)} for i in range(5)]
+        fila, liberar, _ = self._fila(capacidade_max=3, pendentes=lambda: pendentes)
+        self.assertEqual(fila.varrer(), 3)
+        self.assertEqual(fila.varrer(), 0)  # já enfileirados ou sem espaço
+        liberar.set()
+
+
+class ClientIpTest(unittest.TestCase):
+    def test_sem_proxy_usa_conexao(self):
+        with mock.patch.dict(os.environ, {"TRUSTED_PROXY_HOPS": "0", "TRUST_PROXY_HEADERS": "false"}):
+            self.assertEqual(admission.client_ip({"x-forwarded-for": "1.1.1.1"}, "9.9.9.9"), "9.9.9.9")
+
+    def test_usa_entrada_do_proxy_confiavel_nao_a_do_cliente(self):
+        headers = {"x-forwarded-for": "6.6.6.6, 1.2.3.4"}  # 6.6.6.6 forjado pelo cliente
+        with mock.patch.dict(os.environ, {"TRUSTED_PROXY_HOPS": "1"}):
+            self.assertEqual(admission.client_ip(headers, "10.0.0.1"), "1.2.3.4")
+        with mock.patch.dict(os.environ, {"TRUSTED_PROXY_HOPS": "2"}):
+            self.assertEqual(admission.client_ip({"x-forwarded-for": "6.6.6.6, 1.2.3.4, 10.0.0.2"}, None), "1.2.3.4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Backup online com escritores concorrentes: todo snapshot precisa restaurar íntegro."""
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+API_DIR = Path(__file__).resolve().parent.parent
+_tmp = tempfile.TemporaryDirectory(prefix="petstory-test-backup-")
+
+
+def setUpModule():
+    # store/telemetry/backup leem os caminhos no import: isola tudo numa pasta temporária.
+    raiz = Path(_tmp.name)
+    os.environ.update({
+        "PETSTORY_DATA_DIR": str(raiz / "data"),
+        "PETSTORY_UPLOADS_DIR": str(raiz / "uploads"),
+        "TELEMETRY_DB": str(raiz / "telemetry.db"),
+        "BACKUP_DIR": str(raiz / "backups"),
+    })
+    sys.path.insert(0, str(API_DIR))
+    global backup, store, telemetry
+    import backup
+    import store
+    import telemetry
+    telemetry.init_db()
+
+
+def tearDownModule():
+    _tmp.cleanup()
+
+
+class BackupConcorrenteTest(unittest.TestCase):
+    def _escritores(self, parar: threading.Event) -> list[threading.Thread]:
+        def pedidos():
+            while not parar.is_set():
+                order_id = store.create_order(pet_name="Rex", user_email="a@b.c", file_names=[])
+                store.update_order_status(order_id, "processado")
+
+        def eventos():
+            conn = sqlite3.connect(str(telemetry.TELEMETRY_DB), timeout=5)
+            while not parar.is_set():
+                conn.execute(
+                    "INSERT INTO telemetry_events (session_id, event_name, path, timestamp) VALUES (?, ?, ?, ?)",
+                    ("s", "page_view", "/", "2026-01-01T00:00:00Z"),
+                )
+                conn.commit()
+            conn.close()
+
+        return [threading.Thread(target=pedidos), threading.Thread(target=eventos)]
+
+    def test_snapshots_restauram_com_escritores_concorrentes(self):
+        parar = threading.Event()
+        threads = self._escritores(parar)
+        for t in threads:
+            t.start()
+        try:
+            manifestos = [backup.criar_snapshot() for _ in range(20)]
+        finally:
+            parar.set()
+            for t in threads:
+                t.join()
+
+        anterior = -1
+        for i, manifesto in enumerate(manifestos):
+            destino = Path(_tmp.name) / f"restaurado-{i}"
+            backup.restaurar(destino, nome=manifesto["nome"])  # levanta ValueError se o objeto não bate com o hash
+            pedidos = json.loads((destino / "data" / "orders.json").read_text(encoding="utf-8"))
+            self.assertGreaterEqual(len(pedidos), anterior)
+            anterior = len(pedidos)
+            conn = sqlite3.connect(str(destino / "telemetry.db"))
+            try:
+                self.assertEqual(conn.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+            finally:
+                conn.close()
+
+    def test_objeto_reaproveitado_quando_nada_mudou(self):
+        store.create_order(pet_name="Rex", user_email="a@b.c", file_names=[])
+        primeiro = backup.criar_snapshot()
+        segundo = backup.criar_snapshot()
+        self.assertEqual(primeiro["arquivos"]["data/orders.json"], segundo["arquivos"]["data/orders.json"])
+        self.assertEqual(segundo["objetos_novos"], 0)
+
+    def test_arquivo_sem_mudanca_nao_e_lido_de_novo(self):
+        store.create_order(pet_name="Rex", user_email="a@b.c", file_names=[])
+        backup.criar_snapshot()
+        with mock.patch.object(backup, "_guardar", wraps=backup._guardar) as guardar:
+            backup.criar_snapshot()
+        self.assertEqual([c.args[0].name for c in guardar.call_args_list], ["telemetry.db"])  # só a cópia nova
+        store.create_order(pet_name="Bob", user_email="a@b.c", file_names=[])
+        with mock.patch.object(backup, "_guardar", wraps=backup._guardar) as guardar:
+            backup.criar_snapshot()
+        self.assertIn(store.ORDERS_FILE, [c.args[0] for c in guardar.call_args_list])
+
+    def test_snapshot_recusado_durante_poda(self):
+        with backup._exclusivo(esperar=True):
+            with self.assertRaises(RuntimeError):
+                backup.criar_snapshot()
+        backup.criar_snapshot()
+
+
+if __name__ == "__main__":
+    unittest.main()
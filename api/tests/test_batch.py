@@ -0,0 +1,76 @@
+"""Modo lote ponta a ponta com o backend local: submeter, coletar (em "outro processo") e finalizar."""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent
+_tmp = tempfile.TemporaryDirectory(prefix="petstory-test-batch-")
+
+
+def setUpModule():
+    global batch, fakes, gemini, process, sink, store
+    sys.path.insert(0, str(API_DIR))
+    import fakes
+    sink = fakes.SmtpSink(latencia=0).start()
+    raiz = Path(_tmp.name)
+    os.environ.update({
+        "PETSTORY_DATA_DIR": str(raiz / "data"),
+        "PETSTORY_UPLOADS_DIR": str(raiz / "uploads"),
+        "GEMINI_BACKEND": "local",
+        "GEMINI_LOCAL_LATENCY": "0",
+        "GEMINI_LOCAL_BATCH_SECONDS": "0",
+        "SMTP_SERVER": sink.host,
+        "SMTP_PORT": str(sink.port),
+        "SMTP_USER": "teste",
+        "SMTP_PASSWORD": "teste",
+        "SMTP_STARTTLS": "false",
+        "EMAIL_FROM": "teste@petstory.invalid",
+        "EMAIL_TO": "",
+    })
+    import batch
+    import gemini
+    import process
+    import store
+
+
+def tearDownModule():
+    sink.stop()
+    _tmp.cleanup()
+
+
+class LoteLocalTest(unittest.TestCase):
+    def _pedido_pago(self) -> dict:
+        order_id = store.create_order(pet_name="Rex", user_email="dono@petstory.invalid", file_names=[])
+        pasta = store.UPLOADS_DIR / order_id
+        pasta.mkdir(parents=True, exist_ok=True)
+        (pasta / "foto.png").write_bytes(fakes.png_bytes(256, 256, seed=1))
+        store.update_order_file_names(order_id, ["foto.png"])
+        store.update_order_pagamento(order_id, "ok")
+        return {**store.get_order(order_id), "order_id": order_id}
+
+    def test_submeter_coletar_finalizar(self):
+        pedido = self._pedido_pago()
+        lotes = batch.submeter([pedido])
+        self.assertEqual(len(lotes), 1)
+        self.assertTrue(process.aguardando_lote(pedido))
+        self.assertEqual(process.geracoes_pendentes(pedido), [])  # em lote: ninguém gera de novo
+        self.assertFalse(process.processar_pedido(pedido))
+
+        gemini._backend = None  # coleta como --so-coletar: outra instância, estado só no disco
+        self.assertEqual(batch.coletar(), 0)
+        self.assertEqual(process.manifestos_lote(), [])
+        self.assertEqual(process.geracoes_pendentes(pedido, incluir_em_lote=True), [])
+
+        self.assertEqual(batch._finalizar(store.list_pending_production()), 0)
+        self.assertEqual(store.get_order(pedido["order_id"])["status"], "processado")
+        self.assertTrue((store.UPLOADS_DIR / pedido["order_id"] / process.LIVRO_PDF_NAME).exists())
+        self.assertEqual(len(sink.mensagens), 1)
+
+    def test_lote_sem_estado_falha(self):
+        self.assertEqual(gemini.LocalBackend().estado_lote("local-batches/inexistente"), gemini.LOTE_FALHOU)
+
+
+if __name__ == "__main__":
+    unittest.main()